@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import zlib
+import signal
+import socket
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty
+from threading import Lock, Thread
+
+import run_checker
+import run_writer
+
+from common import transport
+from common.metrics import REGISTRY
+from common.record import make_result, decode_result
+from common.utils import get_log
+
+PHASES = ('checker-thread', 'checker-async', 'writer')
+EARLIEST = -2  # pykafka OffsetType.EARLIEST
+
+
+class LocalWebsites():
+    """ Local HTTP server standing in for checked websites. Every path is a
+        website, its body ends with the pattern 'success'.
+        Arguments:
+        - latency: seconds to wait before response
+        - body_size: response body bytes
+    """
+    def __init__(self, latency=0.0, body_size=1024):
+        self.latency = latency
+        self.body = b'x' * max(body_size - 7, 0) + b'success'
+        self.arrivals = dict()  # path: deque of request arrival times
+        self.lock = Lock()
+        self.server = None
+
+    def start(self):
+        websites = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                # body is written after headers, do not wait for ack
+                self.request.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                websites.arrive(self.path)
+                if websites.latency > 0:
+                    time.sleep(websites.latency)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(websites.body)))
+                self.end_headers()
+                self.wfile.write(websites.body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def arrive(self, path):
+        now = time.monotonic()
+        with self.lock:
+            self.arrivals.setdefault(path, deque()).append(now)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakePartition():
+    def __init__(self, id):
+        self.id = id
+        self.messages = []  # [(produce time, value), ]
+        self.lock = Lock()
+
+    def append(self, value):
+        with self.lock:
+            self.messages.append((time.monotonic(), value))
+
+    def latest_available_offset(self):
+        return len(self.messages)
+
+
+class FakeMessage():
+    def __init__(self, partition_id, offset, value):
+        self.partition_id = partition_id
+        self.offset = offset
+        self.value = value
+
+
+class FakeProducer():
+    """ Producer appending messages to fake partitions, every message is
+        delivered
+    """
+    def __init__(self, topic):
+        self.topic = topic
+        self.reports = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def produce(self, value, partition_key=None):
+        partitions = self.topic.partitions
+        index = zlib.crc32(partition_key or b'') % len(partitions)
+        partitions[index].append(value)
+        self.reports.append((FakeMessage(None, None, value), None))
+
+    def get_delivery_report(self, block=False):
+        try:
+            return self.reports.popleft()
+        except IndexError:
+            raise Empty
+
+
+class FakeConsumer():
+    def __init__(self, partitions, timeout):
+        self.partitions = partitions
+        self.timeout = timeout
+        self.offsets = {partition.id: 0 for partition in partitions}
+
+    def reset_offsets(self, offsets):
+        for partition, offset in offsets:
+            self.offsets[partition.id] = max(offset, 0)
+
+    def consume(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            for partition in self.partitions:
+                offset = self.offsets[partition.id]
+                if offset < len(partition.messages):
+                    self.offsets[partition.id] = offset + 1
+                    return FakeMessage(partition.id, offset,
+                                       partition.messages[offset][1])
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.01)
+
+
+class FakeTopic():
+    def __init__(self, partitions):
+        self.partitions = {i: FakePartition(i) for i in range(partitions)}
+
+    def get_simple_consumer(self, partitions=None, consumer_timeout_ms=500,
+                            **kwargs):
+        partitions = partitions or list(self.partitions.values())
+        return FakeConsumer(partitions, consumer_timeout_ms / 1000)
+
+    def messages(self):
+        """ Return [(produce time, value), ] of all partitions """
+        messages = []
+        for partition in self.partitions.values():
+            messages.extend(partition.messages)
+        return messages
+
+
+class FakeKafka():
+    """ In-process stand-in of common.kafka.Kafka, all instances share
+        the topic set in FakeKafka.topic
+    """
+    topic = None
+
+    def __init__(self, host, port, cafile, certfile, keyfile, log):
+        self.log = log
+        self.offset_type = Namespace(EARLIEST=EARLIEST)
+
+    def set_client(self, tls=True):
+        return True
+
+    def get_topic(self, topic):
+        return FakeKafka.topic
+
+    def get_producer(self, topic, sync=True, **kwargs):
+        return FakeProducer(topic)
+
+
+class RecordingDatabase():
+    """ Stand-in of common.database.PostgreSQL counting written rows """
+    lock = Lock()
+    websites = dict()  # name: id
+    rows = 0
+    batches = 0
+
+    def __init__(self, host, port, dbname, user, password, log,
+                 ingest='values', partition=None, timings=False, pool_size=4,
+                 **kwargs):
+        self.ingest = ingest
+        self.partition = partition
+        self.timings = timings
+        self.pool_size = pool_size
+
+    def connect(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def release(self):
+        pass
+
+    def initialise_database(self):
+        return True
+
+    def maintain_partitions(self):
+        return True
+
+    def get_website(self, name=None, url=None):
+        return []
+
+    def add_websites(self, websites, invalid=None):
+        with RecordingDatabase.lock:
+            ids = dict()
+            for name in websites:
+                ids[name] = RecordingDatabase.websites.setdefault(
+                    name, len(RecordingDatabase.websites) + 1)
+            return ids
+
+    def get_topic_offset(self, name):
+        return False
+
+    def add_topic(self, name, created_at):
+        return True
+
+    def get_partition_offsets(self, name):
+        return dict()
+
+    def add_check_results(self, results, topic_name, partition_offsets,
+                          invalid=None):
+        with RecordingDatabase.lock:
+            RecordingDatabase.rows += len(results)
+            RecordingDatabase.batches += 1
+        return True
+
+
+def percentiles(values):
+    """ Return {p50, p90, p99, max} of values, None when empty """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(percent):
+        index = min(int(len(values) * percent / 100), len(values) - 1)
+        return round(values[index], 6)
+
+    return {'p50': at(50), 'p90': at(90), 'p99': at(99),
+            'max': round(values[-1], 6)}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024  # kilobytes on linux
+    return round(peak / 1024 / 1024, 1)
+
+
+def interrupt_after(seconds):
+    """ Stop main() of checker or writer like Ctrl-C after seconds """
+    def run():
+        time.sleep(seconds)
+        os.kill(os.getpid(), signal.SIGINT)
+    Thread(target=run, daemon=True).start()
+
+
+def write_config(path, args, topic_name, pg_cfg=None):
+    lines = ['[kafka]',
+             '    host = 127.0.0.1',
+             '    port = 9092',
+             '    cafile =',
+             '    certfile =',
+             '    keyfile =',
+             f'    topic = {topic_name}',
+             f'    producer = {args.producer}',
+             '[checker]',
+             f'    format = {args.format}',
+             '    reload_interval = 0',
+             '[writer]',
+             f'    max_rows = {args.max_rows}',
+             f'    max_latency = {args.max_latency}',
+             '[postgre]']
+    pg_cfg = pg_cfg or {'host': '127.0.0.1', 'port': '5432',
+                        'dbname': 'benchmark', 'user': '', 'password': ''}
+    for key, value in pg_cfg.items():
+        lines.append(f'    {key} = {value}')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def bench_checker(args, mode, workdir, log):
+    """ Run run_checker.main against local websites and fake kafka """
+    websites = LocalWebsites(latency=args.latency, body_size=args.body)
+    port = websites.start()
+    website_file = os.path.join(workdir, 'websites.yaml')
+    with open(website_file, 'w') as f:
+        for i in range(args.websites):
+            f.write(f'site{i}:\n'
+                    f'    url: http://127.0.0.1:{port}/site{i}\n'
+                    f'    pattern: success\n')
+    config_file = os.path.join(workdir, 'config.ini')
+    write_config(config_file, args, 'benchmark')
+    FakeKafka.topic = FakeTopic(args.partitions)
+    transport.Kafka = FakeKafka
+    checker_args = Namespace(
+        interval=args.interval, mode=mode, config=config_file,
+        website=website_file, notls=True, concurrency=args.concurrency,
+        nojitter=False, processes=1, shard_index=None, shard_count=None,
+        shard_name=None, shard_members=None, debug=False, filelog=False)
+    interrupt_after(args.duration)
+    start = time.monotonic()
+    run_checker.main(checker_args, log)
+    elapsed = time.monotonic() - start
+    websites.stop()
+
+    # match results of a website to its requests in order
+    response_times = []
+    latencies = []
+    for produced_at, value in sorted(FakeKafka.topic.messages(),
+                                     key=lambda message: message[0]):
+        result = decode_result(value)
+        response_times.append(result['response_time'])
+        arrivals = websites.arrivals.get(f'/{result["name"]}')
+        if arrivals:
+            latencies.append(produced_at - arrivals.popleft())
+    return {
+        'websites': args.websites,
+        'interval': args.interval,
+        'target_checks_per_sec': round(args.websites / args.interval, 1),
+        'seconds': round(elapsed, 3),
+        'results': len(response_times),
+        'checks_per_sec': round(len(response_times) / elapsed, 1),
+        'response_time': percentiles(response_times),
+        'end_to_end_latency': percentiles(latencies),
+        'peak_rss_mb': peak_rss_mb(),
+        'metrics': REGISTRY.snapshot(),
+    }
+
+
+def bench_writer(args, workdir, log):
+    """ Run run_writer.main on results in fake kafka """
+    topic_name = f'benchmark-{int(time.time())}'
+    pg_cfg = None
+    if args.config != None:
+        pg_cfg = run_writer.get_config(args.config, 'postgre')
+    else:
+        run_writer.PostgreSQL = RecordingDatabase
+    config_file = os.path.join(workdir, 'config.ini')
+    write_config(config_file, args, topic_name, pg_cfg)
+    topic = FakeTopic(args.partitions)
+    producer = FakeProducer(topic)
+    now = time.time()
+    for i in range(args.rows):
+        name = f'site{i % args.websites}'
+        value = make_result(name, f'http://127.0.0.1/{name}', now, 0.05,
+                            200, True, content_status='found',
+                            format=args.format)
+        producer.produce(value, partition_key=name.encode('utf-8'))
+    FakeKafka.topic = topic
+    transport.Kafka = FakeKafka
+    run_writer.args = Namespace(config=config_file, notls=True)
+    written = REGISTRY.counter('writer_rows_written_total')
+    done = dict()
+
+    def watch():
+        start = time.monotonic()
+        while written.value < args.rows and \
+                time.monotonic() - start < args.duration * 10:
+            time.sleep(0.01)
+        done['seconds'] = time.monotonic() - start
+        os.kill(os.getpid(), signal.SIGINT)
+
+    Thread(target=watch, daemon=True).start()
+    run_writer.main(None, log)
+    elapsed = done.get('seconds', 0) or 1e-9
+    return {
+        'sink': 'postgresql' if pg_cfg else 'recording',
+        'rows': args.rows,
+        'written': written.value,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(written.value / elapsed, 1),
+        'peak_rss_mb': peak_rss_mb(),
+        'metrics': REGISTRY.snapshot(),
+    }
+
+
+def run_phase(args):
+    """ Run one phase in this process and write its report """
+    log = get_log(name='benchmark', level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.phase == 'writer':
+            report = bench_writer(args, workdir, log)
+        else:
+            mode = args.phase.split('-')[1]
+            report = bench_checker(args, mode, workdir, log)
+    with open(args.result, 'w') as f:
+        json.dump(report, f)
+
+
+def main(args):
+    """ Run every phase in its own process, so peak RSS and metrics of
+        one phase do not include the others
+    """
+    options = {key: value for key, value in vars(args).items()
+               if key not in ('phase', 'result', 'output', 'phases')}
+    report = {
+        'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': options,
+        'phases': dict(),
+    }
+    for phase in args.phases.split(','):
+        if phase not in PHASES:
+            raise Exception(f'unknown phase {phase}, one of {PHASES}.')
+        with tempfile.NamedTemporaryFile(suffix='.json') as result:
+            command = [sys.executable, os.path.abspath(__file__),
+                       '--phase', phase, '--result', result.name]
+            for key, value in options.items():
+                if value != None:
+                    command += [f'--{key.replace("_", "-")}', str(value)]
+            print(f'run {phase} ...', flush=True)
+            subprocess.run(command, check=True)
+            phase_report = json.load(open(result.name))
+        report['phases'][phase] = phase_report
+        summary = {key: value for key, value in phase_report.items()
+                   if key != 'metrics'}
+        print(f'{phase}: {json.dumps(summary)}', flush=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'report saved to {args.output}')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Website monitor - benchmark')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='comma separated phases to run')
+    parser.add_argument('--websites', type=int, default=200,
+                        help='number of local websites')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='checking interval of websites')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run each checker phase')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds local websites wait before response')
+    parser.add_argument('--body', type=int, default=16384,
+                        help='body bytes of local websites')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='maximum concurrent checks in async mode')
+    parser.add_argument('--format', default='binary',
+                        choices=['json', 'binary'], help='result format')
+    parser.add_argument('--producer', default='async',
+                        choices=['sync', 'async'], help='producer mode')
+    parser.add_argument('--partitions', type=int, default=4,
+                        help='partitions of fake topic')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='results consumed by writer phase')
+    parser.add_argument('--max-rows', type=int, default=1000,
+                        help='writer batch size')
+    parser.add_argument('--max-latency', type=float, default=1,
+                        help='writer batch latency')
+    parser.add_argument('--config',
+                        help='config file with postgre section to write to '
+                             'PostgreSQL instead of recording sink')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='report file')
+    parser.add_argument('--phase', help='run one phase, used internally')
+    parser.add_argument('--result', help='phase report file, internal')
+    args = parser.parse_args()
+    if args.phase != None:
+        run_phase(args)
+    else:
+        main(args)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import codecs
+import hashlib
+
+from functools import lru_cache
+
+try:
+    from re import _parser as sre_parse  # python 3.11 and later
+except ImportError:
+    import sre_parse
+
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+TRUNCATED = 'truncated'  # body size limit reached before pattern found
+
+CHUNK_SIZE = 16384
+CACHE_MAX_SIZE = 1048576  # larger bodies are not kept in content cache
+DEFAULT_ENCODING = 'utf-8'  # body encoding when response has no charset
+CHARSET = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def compile_pattern(pattern):
+    """ Compile pattern to search body decoded to text """
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=1024)
+def pattern_width(pattern, flags=0):
+    """ Return maximum characters of a match of pattern, None when
+        unbounded
+    """
+    width = sre_parse.parse(pattern, flags).getwidth()[1]
+    if width >= sre_parse.MAXREPEAT:
+        return None
+    return width
+
+
+def body_decoder(content_type):
+    """ Return incremental decoder of body with charset of content type
+        header, utf-8 when it is missing or unknown
+    """
+    encoding = DEFAULT_ENCODING
+    match = CHARSET.search(content_type or '')
+    if match:
+        encoding = match.group(1)
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)
+    except LookupError:
+        decoder = codecs.getincrementaldecoder(DEFAULT_ENCODING)
+    return decoder(errors='replace')
+
+
+def body_digest(data=b''):
+    return hashlib.blake2b(data, digest_size=16)
+
+
+class ContentCache():
+    """ Validators and body digest of last response of one website, to
+        send conditional requests and skip scanning unchanged body
+    """
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.digest = None  # digest of first size bytes of body scanned
+        self.size = 0
+        self.status = None  # content status of last scanned body
+
+    def headers(self):
+        """ Return conditional request headers """
+        headers = dict()
+        if self.status == None:
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def update_validators(self, headers):
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+
+
+class BodyScanner():
+    """ Search pattern in body chunks without keeping the whole body.
+        Chunks are decoded with charset of response, so patterns match
+        text. The last characters of previous chunk are kept and searched
+        again with next chunk, at least as many as the longest match of
+        pattern, so matches across chunk boundary are found. A pattern
+        with unbounded repeat searches all text read so far, max_size
+        limits it.
+        With a cache, body is first compared with digest of the body
+        scanned last time and the previous status is reused when it is the
+        same, call finish() after the last chunk.
+        Arguments:
+        - pattern: compiled pattern
+        - max_size: stop reading body after this many bytes, 0 no limit
+        - overlap: minimum characters of previous chunk kept for next search
+        - cache: ContentCache of website, None to always scan
+    """
+    def __init__(self, pattern, max_size=0, overlap=1024, cache=None):
+        self.pattern = pattern
+        self.max_size = max_size
+        width = pattern_width(pattern.pattern, pattern.flags)
+        self.overlap = None if width == None else max(overlap, width)
+        self.decoder = body_decoder(None)
+        self.size = 0
+        self.tail = ''
+        self.status = NOT_FOUND
+        self.cache = cache
+        self.cache_hit = False
+        self.done = False
+        self.digest = body_digest()
+        # chunks read while comparing with cached digest
+        self.verify = cache != None and cache.digest != None
+        self.pending = []
+        self.pending_size = 0
+
+    def response(self, status_code, headers):
+        """ Handle response status and headers before body,
+            return True when body is not needed
+        """
+        self.decoder = body_decoder(headers.get('Content-Type'))
+        if self.cache == None:
+            return False
+        if status_code == 304 and self.cache.status != None:
+            self.done = self._hit()
+            return True
+        if status_code == 200:
+            self.cache.update_validators(headers)
+        return False
+
+    def feed(self, chunk):
+        """ Scan one chunk, return True when no more body is needed """
+        if self.verify:
+            self.done = self._verify(chunk)
+        else:
+            self.done = self._scan(chunk)
+        return self.done
+
+    def _scan(self, chunk):
+        if self.max_size and self.size + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.size]
+            self.status = TRUNCATED
+        self.size += len(chunk)
+        self.digest.update(chunk)
+        data = self.tail + self.decoder.decode(chunk)
+        if self.pattern.search(data):
+            self.status = FOUND
+            self._store()
+            return True
+        self.tail = data if self.overlap == None else data[-self.overlap:]
+        if self.status == TRUNCATED:
+            self._store()
+            return True
+        return False
+
+    def _verify(self, chunk):
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        if self.pending_size < self.cache.size:
+            return False
+        if self.cache.status == NOT_FOUND:
+            if self.pending_size == self.cache.size:
+                return False  # same only if body ends here, see finish()
+            return self._rescan()
+        # pattern was found or size limit reached within cached size
+        data = b''.join(self.pending)
+        if body_digest(data[:self.cache.size]).digest() == \
+                self.cache.digest:
+            return self._hit()
+        return self._rescan()
+
+    def _hit(self):
+        self.verify = False
+        self.pending = []
+        self.status = self.cache.status
+        self.cache_hit = True
+        return True
+
+    def _rescan(self):
+        """ Body changed, scan chunks read so far """
+        self.verify = False
+        data = b''.join(self.pending)
+        self.pending = []
+        return self._scan(data)
+
+    def finish(self):
+        """ Body ended, no more chunks """
+        if self.done:
+            return
+        self.done = True
+        if self.verify:
+            data = b''.join(self.pending)
+            if self.cache.status == NOT_FOUND and \
+                    len(data) == self.cache.size and \
+                    body_digest(data).digest() == self.cache.digest:
+                self._hit()
+                return
+            if self._rescan():
+                return
+        self._store()
+
+    def _store(self):
+        if self.cache == None:
+            return
+        if self.size > CACHE_MAX_SIZE:
+            # forget previous body, next request is unconditional
+            self.cache.digest = None
+            self.cache.status = None
+            self.cache.etag = None
+            self.cache.last_modified = None
+            return
+        self.cache.digest = self.digest.digest()
+        self.cache.size = self.size
+        self.cache.status = self.status
+
+    @property
+    def found(self):
+        return self.status == FOUND
@@ -1,37 +1,138 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
+import time
+import struct
 import psycopg2
 
+from datetime import datetime, timedelta
+from threading import local, RLock
+
 from psycopg2 import sql
 from psycopg2 import extras
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+
+from common.pgcopy import text_buffer, binary_buffer, to_datetime
+from common.rollup import ROLLUPS, aggregate
+
+STATUS_HISTORY_COLUMNS = ('created_at', 'website_id', 'status_code',
+                          'response_time', 'content_check')
+STATUS_HISTORY_TYPES = ('timestamp', 'int4', 'int4', 'float4', 'bool')
+# optional phase timing columns, in order of record.TIMING_PHASES
+TIMING_COLUMNS = ('dns_time', 'connect_time', 'tls_time', 'ttfb_time',
+                  'transfer_time')
+
+PARTITION_DAYS = {'daily': 1, 'weekly': 7}
+
+# errors of lost or unusable connection, worth reconnecting and retrying
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# errors of rows database never accepts, retrying them is useless
+DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
 
 
 class PostgreSQL():
-    def __init__(self, host, port, dbname, user, password, log):
+    """ Each thread uses its own connection taken from a pool. A broken
+        connection is dropped and replaced on next use, batch writes are
+        retried with backoff after connection errors.
+    """
+    def __init__(self, host, port, dbname, user, password, log,
+                 ingest='values', partition=None, partition_ahead=3,
+                 retention_days=0, rollup=False, pool_size=4, retries=3,
+                 retry_delay=0.5, health_check=30, connect_timeout=10,
+                 timings=False):
         self.host = host
         self.port = port
         self.dbname = dbname
         self.user = user
         self.password = password
         self.log = log
-        self.conn = None
+        self.ingest = ingest  # values, copy or copy_binary
+        self.partition = partition  # None, daily or weekly
+        self.partition_ahead = partition_ahead  # partitions created ahead
+        self.retention_days = retention_days  # 0 to keep all partitions
+        self.rollup = rollup  # maintain per minute and hour rollup tables
+        self.partitions = set()  # names of existing partitions
+        self.partition_lock = RLock()  # threads create partitions in turn
+        self.pool_size = pool_size  # maximum connections
+        self.retries = retries  # retries of batch write on connection error
+        self.retry_delay = retry_delay  # first retry delay, doubled each time
+        self.health_check = health_check  # check connection idle this long
+        self.connect_timeout = connect_timeout
+        self.timings = timings  # store phase timings in status_history
+        self.pool = None
+        self.local = local()  # connection of current thread
 
     def connect(self):
         try:
-            self.conn = psycopg2.connect(host=self.host,
-                                         port=self.port,
-                                         dbname=self.dbname,
-                                         user=self.user,
-                                         password=self.password)
+            self.pool = ThreadedConnectionPool(
+                1, self.pool_size,
+                host=self.host,
+                port=self.port,
+                dbname=self.dbname,
+                user=self.user,
+                password=self.password,
+                connect_timeout=self.connect_timeout)
             return True
         except Exception as e:
             self.log.error(e)
             return False
 
     def disconnect(self):
-        if self.conn != None:
-            return self.conn.close()
+        if self.pool != None and not self.pool.closed:
+            return self.pool.closeall()
+
+    @property
+    def conn(self):
+        """ Connection of current thread, taken from pool on first use or
+            when previous one is broken. An idle connection is checked only
+            between transactions, a check rolls back the open transaction.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn != None and not conn.closed and \
+                conn.info.transaction_status == TRANSACTION_STATUS_IDLE and \
+                time.monotonic() - self.local.used_at > self.health_check:
+            try:  # connection may be dropped while idle
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except CONNECTION_ERRORS as e:
+                self.log.warning(f'database connection check failed. {e}')
+        if conn != None and conn.closed:
+            self.release()
+            conn = None
+        if conn == None:
+            conn = self.pool.getconn()
+            self.local.conn = conn
+        self.local.used_at = time.monotonic()
+        return conn
+
+    def release(self):
+        """ Return connection of current thread to pool """
+        conn = getattr(self.local, 'conn', None)
+        if conn == None:
+            return
+        self.local.conn = None
+        try:
+            self.pool.putconn(conn, close=bool(conn.closed))
+        except Exception as e:
+            self.log.warning(f'unable to return database connection. {e}')
+
+    def _rollback(self):
+        """ Roll back transaction of current thread, a broken connection
+            is released and replaced on next use
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn == None:
+            return
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except CONNECTION_ERRORS as e:
+                self.log.warning(f'unable to rollback. {e}')
+        if conn.closed:
+            self.release()
 
     def initialise_database(self):
         try:
@@ -44,26 +145,92 @@ class PostgreSQL():
                     topic_offset BIGINT NOT NULL
                 );
             """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS topic_partition (
+                    topic_name VARCHAR (32) NOT NULL,
+                    partition_id INT NOT NULL,
+                    updated_at TIMESTAMP,
+                    partition_offset BIGINT NOT NULL,
+                    PRIMARY KEY (topic_name, partition_id)
+                );
+            """)
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS website (
-                    name VARCHAR (32) PRIMARY KEY,
+                    id SERIAL PRIMARY KEY,
+                    name VARCHAR (32) UNIQUE NOT NULL,
                     created_at TIMESTAMP,
                     url VARCHAR (128) NOT NULL
                 );
             """)
+            # website table created by previous version has no id
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS status_history (
-                    id bigserial PRIMARY KEY,
-                    created_at TIMESTAMP NOT NULL,
-                    website_name VARCHAR (32) NOT NULL,
-                    status_code INT NOT NULL,
-                    response_time FLOAT (3) NOT NULL,
-                    content_check BOOLEAN,
-                    CONSTRAINT fk_website
-                        FOREIGN KEY(website_name)
-                            REFERENCES website(name)
-                );
+                ALTER TABLE website ADD COLUMN IF NOT EXISTS id SERIAL UNIQUE
             """)
+            if self.partition in PARTITION_DAYS:
+                # partition by created_at to drop expired data by partition
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS status_history (
+                        id bigserial,
+                        created_at TIMESTAMP NOT NULL,
+                        website_id INT NOT NULL,
+                        status_code INT NOT NULL,
+                        response_time FLOAT (3) NOT NULL,
+                        content_check BOOLEAN,
+                        PRIMARY KEY (id, created_at),
+                        CONSTRAINT fk_website_id
+                            FOREIGN KEY(website_id)
+                                REFERENCES website(id)
+                    ) PARTITION BY RANGE (created_at);
+                """)
+            else:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS status_history (
+                        id bigserial PRIMARY KEY,
+                        created_at TIMESTAMP NOT NULL,
+                        website_id INT NOT NULL,
+                        status_code INT NOT NULL,
+                        response_time FLOAT (3) NOT NULL,
+                        content_check BOOLEAN,
+                        CONSTRAINT fk_website_id
+                            FOREIGN KEY(website_id)
+                                REFERENCES website(id)
+                    );
+                """)
+            self._migrate_website_id(cur, 'status_history')
+            if self.timings:
+                for column in TIMING_COLUMNS:
+                    cur.execute(sql.SQL("""
+                        ALTER TABLE status_history
+                            ADD COLUMN IF NOT EXISTS {} FLOAT (3)
+                    """).format(sql.Identifier(column)))
+            for table, seconds in ROLLUPS:
+                cur.execute(sql.SQL("""
+                    CREATE TABLE IF NOT EXISTS {} (
+                        website_id INT NOT NULL,
+                        bucket TIMESTAMP NOT NULL,
+                        check_count INT NOT NULL,
+                        success_count INT NOT NULL,
+                        content_fail_count INT NOT NULL,
+                        response_time_min FLOAT (3) NOT NULL,
+                        response_time_max FLOAT (3) NOT NULL,
+                        response_time_sum FLOAT NOT NULL,
+                        response_time_sketch INT[] NOT NULL,
+                        PRIMARY KEY (website_id, bucket)
+                    );
+                """).format(sql.Identifier(table)))
+                self._migrate_website_id(cur, table, ('website_id', 'bucket'))
+            if self.partition in PARTITION_DAYS:
+                cur.execute("""
+                    SELECT relkind FROM pg_class
+                    WHERE relname = 'status_history'
+                """)
+                if cur.fetchone()[0] != 'p':
+                    self.log.warning('status_history is not a partitioned '
+                                     'table, partitioning is disabled.')
+                    self.partition = None
+                else:
+                    self._load_partitions(cur)
+                    self._create_upcoming_partitions(cur, datetime.now())
             self.conn.commit()
             return True
         except Exception as e:
@@ -79,7 +246,8 @@ class PostgreSQL():
                 cur.execute("""
                     SELECT
                         name,
-                        url
+                        url,
+                        id
                     FROM
                         website
                 """)
@@ -87,7 +255,8 @@ class PostgreSQL():
                 sql = """
                     SELECT
                         name,
-                        url
+                        url,
+                        id
                     FROM
                         website
                     WHERE
@@ -125,6 +294,65 @@ class PostgreSQL():
         finally:
             cur.close()
 
+    def add_websites(self, websites, invalid=None):
+        """ Add websites not in database and return their ids
+            Arguments:
+            - websites: {name: url}, url is updated when not empty
+            - invalid: list collecting names of websites database rejects,
+                       a rejected website fails the whole call when None
+            Return {name: id}
+        """
+        try:
+            return self._add_websites(websites)
+        except DATA_ERRORS as e:
+            self._rollback()
+            if invalid == None:
+                self.log.error(e)
+                return False
+            self.log.warning(f'invalid website, add websites one by one. '
+                             f'{e}')
+        except Exception as e:
+            self._rollback()
+            self.log.error(e)
+            return False
+        ids = dict()
+        for name, url in websites.items():
+            try:
+                ids.update(self._add_websites({name: url}))
+            except DATA_ERRORS as e:
+                self._rollback()
+                self.log.warning(f'skip invalid website {name}. {e}')
+                invalid.append(name)
+            except Exception as e:
+                self._rollback()
+                self.log.error(e)
+                return False
+        return ids
+
+    def _add_websites(self, websites):
+        """ Upsert websites in a transaction, raise on error """
+        conn = self.conn  # same connection until commit
+        with conn.cursor() as cur:
+            sql = """
+                INSERT INTO website AS w (
+                    created_at,
+                    name,
+                    url
+                )
+                VALUES %s
+                ON CONFLICT (name) DO UPDATE
+                SET
+                    url = CASE WHEN EXCLUDED.url <> ''
+                          THEN EXCLUDED.url ELSE w.url END
+                RETURNING name, id
+            """
+            now = datetime.now()
+            values = [(now, name, url or '')
+                      for name, url in sorted(websites.items())]
+            rows = extras.execute_values(cur, sql, values, fetch=True)
+        conn.commit()
+        return dict(rows)
+
     def del_website(self, name, url):
         """  for test purpose """
         try:
@@ -192,36 +420,388 @@ class PostgreSQL():
         finally:
             cur.close()
 
-    def add_check_results(self, results, topic_name, topic_offset):
+    def get_partition_offsets(self, name):
+        """ Return {partition id: offset} of topic """
+        try:
+            cur = self.conn.cursor()
+            sql = """
+                SELECT
+                    partition_id,
+                    partition_offset
+                FROM
+                    topic_partition
+                WHERE
+                    topic_name = %s
+            """
+            vars = (name, )
+            cur.execute(sql, vars)
+            return dict(cur.fetchall())
+        except Exception as e:
+            self.log.error(e)
+            return False
+        finally:
+            cur.close()
+
+    def add_check_results(self, results, topic_name, partition_offsets,
+                          invalid=None):
         """ Insert bulk status data and
-            update offset value in topic
+            update offset value of topic partitions
             Arguments:
-            - results: [(...), ]
+            - results: [(created_at, website_id, status_code, response_time,
+                         content_check), ], followed by TIMING_COLUMNS
+                         values when timings is enabled
             - topic_name: str
-            - topic_offset: int
+            - partition_offsets: {partition id: offset}
+            - invalid: list collecting rows database rejects, other rows
+                       and offsets are still stored. A rejected row fails
+                       the whole batch when None
         """
-        try:
-            with self.conn.cursor() as cur:
-                sql_status_history = """
-                INSERT INTO status_history (
-                    created_at,
-                    website_name,
-                    status_code,
-                    response_time,
-                    content_check
+        delay = self.retry_delay
+        retry = 0
+        skip_invalid = False  # insert rows one by one after data error
+        while True:
+            try:
+                self._add_check_results(results, topic_name,
+                                        partition_offsets,
+                                        invalid if skip_invalid else None)
+                return True
+            except CONNECTION_ERRORS as e:
+                self._rollback()
+                self._reload_partitions()
+                if skip_invalid:
+                    del invalid[:]  # collected again on retry
+                if retry == self.retries:
+                    self.log.error(e)
+                    return False
+                self.log.warning(f'database connection error, retry in '
+                                 f'{delay:.1f} seconds. {e}')
+                time.sleep(delay)
+                delay *= 2
+                retry += 1
+            except DATA_ERRORS as e:
+                self._rollback()
+                self._reload_partitions()
+                if invalid == None or skip_invalid:
+                    self.log.error(e)
+                    return False
+                self.log.warning(f'invalid result in batch, skip invalid '
+                                 f'results. {e}')
+                skip_invalid = True
+            except Exception as e:
+                self._rollback()
+                self._reload_partitions()
+                self.log.error(e)
+                return False
+
+    def _add_check_results(self, results, topic_name, partition_offsets,
+                           invalid=None):
+        """ Write one batch in a transaction, raise on error. When invalid
+            is a list, every row is inserted in its own savepoint and
+            rejected rows are appended to invalid
+        """
+        if self.partition in PARTITION_DAYS:
+            # partitions for results older than created ones
+            starts = set(self._partition_start(to_datetime(result[0]))
+                         for result in results)
+            self._ensure_partitions(starts)
+        conn = self.conn  # same connection until commit
+        with conn.cursor() as cur:
+            if invalid == None:
+                self._insert_results(cur, results)
+            else:
+                valid = []
+                for result in results:
+                    cur.execute('SAVEPOINT result')
+                    try:
+                        self._insert_results(cur, [result])
+                    except DATA_ERRORS:
+                        cur.execute('ROLLBACK TO SAVEPOINT result')
+                        invalid.append(result)
+                        continue
+                    cur.execute('RELEASE SAVEPOINT result')
+                    valid.append(result)
+                results = valid
+            if self.rollup and results:
+                self._update_rollups(cur, results)
+            sql_partition = """
+                INSERT INTO topic_partition (
+                    topic_name,
+                    partition_id,
+                    updated_at,
+                    partition_offset
                 )
                 VALUES %s
-                """
-                extras.execute_values(cur, sql_status_history, results)
-                sql_topic = """
-                    UPDATE topic
-                    SET topic_offset = %s
-                    WHERE name = %s
-                """
-                vars = (topic_offset, topic_name, )
-                cur.execute(sql_topic, vars)
+                ON CONFLICT (topic_name, partition_id) DO UPDATE
+                SET
+                    updated_at = EXCLUDED.updated_at,
+                    partition_offset = EXCLUDED.partition_offset
+                WHERE
+                    topic_partition.partition_offset <
+                        EXCLUDED.partition_offset
+            """
+            now = datetime.now()
+            values = [(topic_name, partition, now, offset)
+                      for partition, offset in partition_offsets.items()]
+            extras.execute_values(cur, sql_partition, values)
+        conn.commit()
+
+    def _insert_results(self, cur, results):
+        """ Insert results into status_history with ingest method """
+        if self.ingest == 'copy':
+            self._copy_results(cur, results, binary=False)
+        elif self.ingest == 'copy_binary':
+            self._copy_results(cur, results, binary=True)
+        else:
+            sql_status_history = f"""
+            INSERT INTO status_history (
+                {', '.join(self._columns())}
+            )
+            VALUES %s
+            """
+            extras.execute_values(cur, sql_status_history, results)
+
+    def _migrate_website_id(self, cur, table, key=None):
+        """ Replace website_name of table created by previous version with
+            website_id
+            Arguments:
+            - table: status_history or rollup table name
+            - key: primary key columns to add back, website_name was part
+                   of primary key of rollup tables
+        """
+        cur.execute("""
+            SELECT
+                column_name
+            FROM
+                information_schema.columns
+            WHERE
+                table_name = %s
+            AND
+                column_name = 'website_name'
+        """, (table,))
+        if cur.fetchone() == None:
+            return
+        self.log.warning(f'migrate {table} website_name to website_id')
+        table = sql.Identifier(table)
+        cur.execute(sql.SQL("""
+            ALTER TABLE {} ADD COLUMN IF NOT EXISTS website_id INT
+        """).format(table))
+        cur.execute(sql.SQL("""
+            UPDATE {} AS t
+            SET website_id = website.id
+            FROM website
+            WHERE website.name = t.website_name
+        """).format(table))
+        cur.execute(sql.SQL("""
+            ALTER TABLE {} ALTER COLUMN website_id SET NOT NULL
+        """).format(table))
+        # drops constraints using website_name too
+        cur.execute(sql.SQL("""
+            ALTER TABLE {} DROP COLUMN website_name
+        """).format(table))
+        if key == None:
+            cur.execute(sql.SQL("""
+                ALTER TABLE {} ADD CONSTRAINT fk_website_id
+                    FOREIGN KEY(website_id) REFERENCES website(id)
+            """).format(table))
+        else:
+            cur.execute(sql.SQL("""
+                ALTER TABLE {} ADD PRIMARY KEY ({})
+            """).format(table, sql.SQL(', ').join(
+                sql.Identifier(column) for column in key)))
+
+    def _update_rollups(self, cur, results):
+        """ Add results to rollup tables """
+        for table, seconds in ROLLUPS:
+            sql_rollup = sql.SQL("""
+                INSERT INTO {} AS r (
+                    website_id,
+                    bucket,
+                    check_count,
+                    success_count,
+                    content_fail_count,
+                    response_time_min,
+                    response_time_max,
+                    response_time_sum,
+                    response_time_sketch
+                )
+                VALUES %s
+                ON CONFLICT (website_id, bucket) DO UPDATE
+                SET
+                    check_count = r.check_count + EXCLUDED.check_count,
+                    success_count = r.success_count + EXCLUDED.success_count,
+                    content_fail_count =
+                        r.content_fail_count + EXCLUDED.content_fail_count,
+                    response_time_min =
+                        LEAST(r.response_time_min, EXCLUDED.response_time_min),
+                    response_time_max =
+                        GREATEST(r.response_time_max,
+                                 EXCLUDED.response_time_max),
+                    response_time_sum =
+                        r.response_time_sum + EXCLUDED.response_time_sum,
+                    response_time_sketch = ARRAY(
+                        SELECT COALESCE(a, 0) + COALESCE(b, 0)
+                        FROM unnest(r.response_time_sketch,
+                                    EXCLUDED.response_time_sketch)
+                            WITH ORDINALITY AS s(a, b, i)
+                        ORDER BY i)
+            """).format(sql.Identifier(table)).as_string(cur)
+            extras.execute_values(cur, sql_rollup, aggregate(results, seconds))
+
+    def get_rollups(self, name, start, end, hourly=True):
+        """ Return rollup rows of website between start and end time """
+        table = 'status_rollup_1h' if hourly else 'status_rollup_1m'
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(sql.SQL("""
+                    SELECT
+                        bucket,
+                        check_count,
+                        success_count,
+                        content_fail_count,
+                        response_time_min,
+                        response_time_max,
+                        response_time_sum,
+                        response_time_sketch
+                    FROM
+                        {}
+                    WHERE
+                        website_id = (SELECT id FROM website WHERE name = %s)
+                    AND
+                        bucket >= %s
+                    AND
+                        bucket < %s
+                    ORDER BY
+                        bucket
+                """).format(sql.Identifier(table)), (name, start, end, ))
+                rows = cur.fetchall()
+            self.conn.commit()
+            return rows
+        except Exception as e:
+            self._rollback()
+            self.log.error(e)
+            return False
+
+    def _columns(self):
+        """ Return status_history columns written by add_check_results """
+        if self.timings:
+            return STATUS_HISTORY_COLUMNS + TIMING_COLUMNS
+        return STATUS_HISTORY_COLUMNS
+
+    def _copy_results(self, cur, results, binary=False):
+        """ Stream results into status_history with COPY FROM STDIN """
+        columns = ', '.join(self._columns())
+        if binary:
+            types = STATUS_HISTORY_TYPES
+            if self.timings:
+                types += ('float4',) * len(TIMING_COLUMNS)
+            try:
+                buffer = binary_buffer(results, types)
+            except (struct.error, ValueError, OverflowError) as e:
+                # value out of range of column type, as rejected by server
+                raise psycopg2.DataError(f'unable to encode result. {e}')
+            sql = f'COPY status_history ({columns}) FROM STDIN ' \
+                  f'WITH (FORMAT binary)'
+        else:
+            buffer = text_buffer(results)
+            sql = f'COPY status_history ({columns}) FROM STDIN'
+        cur.copy_expert(sql, buffer)
+
+    def _partition_start(self, when):
+        """ Return start time of partition including given time """
+        start = datetime(when.year, when.month, when.day)
+        if self.partition == 'weekly':
+            start -= timedelta(days=start.weekday())  # monday
+        return start
+
+    def _load_partitions(self, cur):
+        cur.execute("""
+            SELECT
+                child.relname
+            FROM
+                pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE
+                parent.relname = 'status_history'
+        """)
+        self.partitions = set(row[0] for row in cur.fetchall())
+
+    def _reload_partitions(self):
+        """ Reload partition names after failed transaction """
+        if self.partition not in PARTITION_DAYS:
+            return
+        try:
+            with self.conn.cursor() as cur:
+                self._load_partitions(cur)
+            self.conn.commit()
+        except Exception as e:
+            self.log.error(e)
+
+    def _create_partitions(self, cur, starts):
+        """ Create partitions starting at given times if not exist """
+        days = PARTITION_DAYS[self.partition]
+        for start in sorted(starts):
+            name = f'status_history_p{start:%Y%m%d}'
+            if name in self.partitions:
+                continue
+            cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {} PARTITION OF status_history
+                FOR VALUES FROM (%s) TO (%s)
+            """).format(sql.Identifier(name)),
+                (start, start + timedelta(days=days), ))
+            self.partitions.add(name)
+            self.log.info(f'create partition {name}')
+
+    def _ensure_partitions(self, starts):
+        """ Create missing partitions in their own transaction, so threads
+            sharing this object never insert into a partition created by
+            an uncommitted transaction of another thread
+        """
+        with self.partition_lock:
+            with self.conn.cursor() as cur:
+                self._create_partitions(cur, starts)
+            self.conn.commit()
+
+    def _create_upcoming_partitions(self, cur, now):
+        """ Create current partition and partition_ahead after it """
+        days = PARTITION_DAYS[self.partition]
+        start = self._partition_start(now)
+        starts = [start + timedelta(days=days * i)
+                  for i in range(self.partition_ahead + 1)]
+        self._create_partitions(cur, starts)
+
+    def maintain_partitions(self):
+        """ Create upcoming partitions and drop partitions older than
+            retention days
+        """
+        if self.partition not in PARTITION_DAYS:
+            return True
+        with self.partition_lock:
+            return self._maintain_partitions()
+
+    def _maintain_partitions(self):
+        try:
+            with self.conn.cursor() as cur:
+                now = datetime.now()
+                self._load_partitions(cur)
+                self._create_upcoming_partitions(cur, now)
+                if self.retention_days > 0:
+                    days = PARTITION_DAYS[self.partition]
+                    expire = now - timedelta(days=self.retention_days)
+                    for name in sorted(self.partitions.copy()):
+                        if not re.fullmatch(r'status_history_p\d{8}', name):
+                            continue  # not created by writer
+                        start = datetime.strptime(name[-8:], '%Y%m%d')
+                        if start + timedelta(days=days) > expire:
+                            continue
+                        cur.execute(sql.SQL('DROP TABLE {}').format(
+                            sql.Identifier(name)))
+                        self.partitions.discard(name)
+                        self.log.info(f'drop expired partition {name}')
             self.conn.commit()
             return True
         except Exception as e:
+            self._rollback()
+            self._reload_partitions()
             self.log.error(e)
             return False
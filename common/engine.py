@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from threading import Thread, Lock
+from queue import Full
+
+from common.record import make_result, URL_INTERVAL
+from common.scheduler import Scheduler
+from common.metrics import REGISTRY
+from common.session import get_connector, get_ssl_context
+from common.resolver import get_resolver
+from common.timing import PhaseTimer, get_trace_config
+from common.content import BodyScanner, ContentCache, compile_pattern
+from common.content import CHUNK_SIZE
+
+
+class Site():
+    def __init__(self, name, url, pattern, interval=10, cold=False,
+                 max_body=0, content_cache=False):
+        self.name = name
+        self.url = url
+        self.pattern = compile_pattern(pattern)
+        self.interval = interval
+        self.cold = cold  # check on a new connection every time
+        self.max_body = max_body  # maximum body bytes to scan, 0 no limit
+        self.url_time = 0  # last time url was included in binary result
+        self.running = False  # a check of this site is in flight
+        # skip download or scan of unchanged body
+        self.cache = ContentCache() if content_cache else None
+
+
+class AsyncCheckEngine(Thread):
+    """ Run website checks as coroutines on one event loop.
+        Arguments:
+        - result_queue: queue to forward result to producer
+        - concurrency: maximum number of checks in flight
+        - timeout: total timeout of one check in seconds
+        - jitter: spread first check of websites within their interval
+        - pool_maxsize: maximum keep-alive connections per host
+        - pool_idle_timeout: close keep-alive connection idle this long
+        - format: result record format, json or binary
+        - content_cache: send conditional requests and skip scanning
+                         unchanged body
+        - dns_cache: DnsCache to resolve hosts, None for aiohttp resolver
+        - ssl_context: ssl context shared by connections
+        - timings: add phase timings to results
+    """
+    def __init__(self, result_queue, log, concurrency=100, timeout=30,
+                 jitter=True, pool_maxsize=10, pool_idle_timeout=60,
+                 format='json', content_cache=False, dns_cache=None,
+                 ssl_context=None, timings=False):
+        Thread.__init__(self, daemon=True)
+        self.result_queue = result_queue
+        self.log = log
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.pool_idle_timeout = pool_idle_timeout
+        self.format = format
+        self.content_cache = content_cache
+        self.dns_cache = dns_cache
+        self.ssl_context = ssl_context
+        self.timings = timings
+        self.sites = dict()
+        self.scheduler = Scheduler(jitter=jitter)
+        self.lock = Lock()  # sites may change while engine is running
+        self.overlap = REGISTRY.counter('checker_check_overlap_total',
+                                        'checks skipped as previous check '
+                                        'of the website was still running')
+        self.cache_hits = REGISTRY.counter('checker_content_cache_hit_total',
+                                           'checks reusing content status '
+                                           'of unchanged body')
+        self.duration = REGISTRY.histogram('checker_check_seconds',
+                                           'time taken by one check')
+        self.errors = REGISTRY.counter('checker_check_error_total',
+                                       'checks failed without result')
+        self.stop_flag = False
+
+    def add_site(self, name, url, pattern, interval=10, cold=False,
+                 max_body=0):
+        site = Site(name, url, pattern, interval=interval, cold=cold,
+                    max_body=max_body, content_cache=self.content_cache)
+        with self.lock:
+            self.sites[name] = site
+            self.scheduler.add(name, interval)
+
+    def remove_site(self, name):
+        # check in flight finishes and forwards its result
+        with self.lock:
+            self.sites.pop(name, None)
+            self.scheduler.remove(name)
+
+    def update_site(self, name, url, pattern, interval=10, cold=False,
+                    max_body=0):
+        """ Change website in place, keeping its schedule """
+        compiled = compile_pattern(pattern)
+        with self.lock:
+            site = self.sites.get(name)
+            if site == None:
+                return
+            if site.url != url:
+                site.url_time = 0  # send new url with next result
+            if site.cache != None and (url, compiled, max_body) != \
+                    (site.url, site.pattern, site.max_body):
+                site.cache = ContentCache()
+            site.url = url
+            site.pattern = compiled
+            site.interval = interval
+            site.cold = cold
+            site.max_body = max_body
+            self.scheduler.update(name, interval)
+
+    def run(self):
+        self.log.info(f'start async check engine, sites={len(self.sites)}, '
+                      f'concurrency={self.concurrency}')
+        try:
+            asyncio.run(self._run())
+        except Exception as e:
+            self.log.error(f'async check engine stopped. {e}')
+
+    def stop(self):
+        self.stop_flag = True
+
+    async def _run(self):
+        import aiohttp  # only required in async mode
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        tasks = set()
+        resolver = None
+        if self.dns_cache != None:
+            resolver = get_resolver(self.dns_cache)
+        connector = get_connector(limit=self.concurrency,
+                                  limit_per_host=self.pool_maxsize,
+                                  idle_timeout=self.pool_idle_timeout,
+                                  resolver=resolver,
+                                  ssl_context=self.ssl_context)
+        options = {'timeout': timeout}
+        cold_ssl_context = None
+        if self.timings:
+            options['trace_configs'] = [get_trace_config()]
+            # mark tls handshake start of cold connections too
+            cold_ssl_context = get_ssl_context(resume=False)
+        cold_connector = get_connector(limit=self.concurrency, cold=True,
+                                       ssl_context=cold_ssl_context)
+        async with aiohttp.ClientSession(connector=connector,
+                                         **options) as session, \
+                aiohttp.ClientSession(connector=cold_connector,
+                                      **options) as cold:
+            while not self.stop_flag:
+                with self.lock:
+                    due_sites = [(self.sites.get(name), due)
+                                 for name, due in self.scheduler.pop_due()]
+                    next_due = self.scheduler.next_due()
+                for site, due in due_sites:
+                    if site == None:
+                        continue
+                    if site.running:
+                        self.overlap.inc()
+                        continue
+                    site.running = True
+                    task = asyncio.create_task(
+                        self._check(cold if site.cold else session,
+                                    semaphore, site, due))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                delay = 0.5
+                if next_due != None:
+                    delay = min(max(next_due - time.monotonic(), 0), delay)
+                await asyncio.sleep(delay)
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _check(self, session, semaphore, site, due):
+        try:
+            async with semaphore:
+                self.scheduler.record_lag(due)
+                start = time.monotonic()
+                result = await self.check_website(session, site)
+                self.duration.observe(time.monotonic() - start)
+            await self._put(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors.inc()
+            self.log.error(f'{site.name} - {e}')
+        finally:
+            site.running = False
+
+    async def check_website(self, session, site):
+        if not self.timings:
+            return await self._check_website(session, site)
+        with PhaseTimer() as timer:
+            return await self._check_website(session, site, timer)
+
+    async def _check_website(self, session, site, timer=None):
+        start_time = time.time()
+        headers = dict()
+        if site.cache != None:
+            headers = site.cache.headers()  # conditional request
+        scanner = BodyScanner(site.pattern, max_size=site.max_body,
+                              cache=site.cache)
+        async with session.get(site.url, headers=headers) as r:
+            if timer != None:
+                timer.mark('headers')
+            if not scanner.response(r.status, r.headers):
+                # stop downloading once pattern found or size limit reached
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    if scanner.feed(chunk):
+                        break
+                scanner.finish()
+            response_time = time.time() - start_time
+        timings = None
+        if timer != None:
+            timer.finish()
+            timings = timer.timings()
+        self.log.debug(f'{r.status} - {site.url}')
+        if scanner.cache_hit:
+            self.cache_hits.inc()
+        with_url = start_time - site.url_time > URL_INTERVAL
+        if with_url:
+            site.url_time = start_time
+        return make_result(site.name, site.url, start_time, response_time,
+                           r.status, scanner.found,
+                           content_status=scanner.status,
+                           format=self.format,
+                           with_url=with_url,
+                           cache_hit=scanner.cache_hit,
+                           timings=timings)
+
+    async def _put(self, result):
+        # never block the event loop on a full result queue
+        while True:
+            try:
+                self.result_queue.put_nowait(result)
+                return
+            except Full:
+                await asyncio.sleep(0.05)
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from queue import Empty
+
 from pykafka import KafkaClient, SslConfig
-from pykafka.common import OffsetType
+from pykafka.common import OffsetType, CompressionType
+from pykafka.partitioners import hashing_partitioner
 
 
 class Kafka():
@@ -37,3 +40,65 @@ class Kafka():
         except Exception as e:
             self.log.error(e)
             return False
+
+    def get_producer(self, topic, sync=True, linger_ms=5000, batch_size=70000,
+                     compression='none', max_in_flight=100000):
+        """ Return sync producer, or batched async producer with delivery
+            reports enabled. Messages are partitioned by partition key.
+            Arguments:
+            - topic: pykafka topic
+            - sync: wait broker acknowledge of every message
+            - linger_ms: maximum time to wait for a batch to fill
+            - batch_size: number of queued messages to send a batch
+            - compression: none, gzip, snappy or lz4
+            - max_in_flight: maximum number of queued and unacknowledged
+                             messages, produce blocks when reached
+        """
+        try:
+            if sync:
+                return topic.get_sync_producer(
+                    partitioner=hashing_partitioner)
+            compression_type = getattr(CompressionType, compression.upper())
+            return topic.get_producer(
+                partitioner=hashing_partitioner,
+                linger_ms=linger_ms,
+                min_queued_messages=min(batch_size, max_in_flight),
+                max_queued_messages=max_in_flight,
+                compression=compression_type,
+                block_on_queue_full=True,
+                delivery_reports=True)
+        except Exception as e:
+            self.log.error(e)
+            return False
+
+
+def count_delivery_reports(producer, delivered, failed, log, retry=None,
+                           done=None):
+    """ Drain delivery reports of async producer into counters
+        Arguments:
+        - retry: called with value of every failed message to send it again
+        - done: called with value of every reported message, after retry
+    """
+    while True:
+        try:
+            message, exc = producer.get_delivery_report(block=False)
+        except Empty:
+            return
+        if exc != None:
+            failed.inc()
+            log.debug(f'delivery failed, {exc}')
+            if retry != None:
+                retry(message.value)
+        else:
+            delivered.inc()
+        if done != None:
+            done(message.value)
+
+
+def resume_offset(offset):
+    """ Return offset to reset consumer to, so consuming resumes after last
+        stored offset, or from earliest offset when nothing was stored
+    """
+    if offset < 0:
+        return OffsetType.EARLIEST
+    return offset
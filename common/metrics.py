@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+# upper bounds of size histogram buckets, e.g. rows of a batch
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Counter():
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge():
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = None  # read value from function when set
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function != None:
+            return self.function()
+        return self.value
+
+
+class Histogram():
+    """ Count observed values in buckets of upper bounds, with sum and
+        count of all values
+    """
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def get(self):
+        """ Return (cumulative bucket counts, sum, count) """
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = Lock()
+
+    def _get_or_create(self, cls, name, help, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric == None:
+                metric = cls(name, help, *args)
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        """ Return {name: value} of all metrics """
+        values = dict()
+        for name, metric in list(self.metrics.items()):
+            if isinstance(metric, Gauge):
+                values[name] = metric.get()
+            elif isinstance(metric, Histogram):
+                counts, total, count = metric.get()
+                values[f'{name}_count'] = count
+                values[f'{name}_sum'] = round(total, 6)
+            else:
+                values[name] = metric.value
+        return values
+
+    def render(self):
+        """ Return all metrics in Prometheus text format """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.help}')
+            if isinstance(metric, Histogram):
+                lines.append(f'# TYPE {name} histogram')
+                counts, total, count = metric.get()
+                bounds = metric.buckets + (float('inf'),)
+                for bound, value in zip(bounds, counts):
+                    lines.append(f'{name}_bucket{{le="'
+                                 f'{format_value(bound)}"}} {value}')
+                lines.append(f'{name}_sum {format_value(total)}')
+                lines.append(f'{name}_count {count}')
+                continue
+            if isinstance(metric, Gauge):
+                lines.append(f'# TYPE {name} gauge')
+                try:
+                    value = metric.get()
+                except Exception:
+                    continue  # value function failed, skip sample
+            else:
+                lines.append(f'# TYPE {name} counter')
+                value = metric.value
+            lines.append(f'{name} {format_value(value)}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()  # default registry shared in one process
+
+
+class MetricsServer():
+    """ Serve metrics of registry in Prometheus text format on
+        http://<host>:<port>/metrics from a daemon thread
+    """
+    def __init__(self, port, log, host='127.0.0.1', registry=REGISTRY):
+        self.port = port
+        self.host = host
+        self.log = log
+        self.registry = registry
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes are not logged
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.server.daemon_threads = True
+        except Exception as e:
+            self.log.error(f'unable to serve metrics on {self.host}:'
+                           f'{self.port}. {e}')
+            return False
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.log.info(f'serve metrics on http://{self.host}:{self.port}'
+                      f'/metrics')
+        return True
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import struct
+
+from datetime import datetime
+
+PG_EPOCH = datetime(2000, 1, 1)
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_TRAILER = struct.pack('>h', -1)
+
+FIELD_COUNT = struct.Struct('>h')
+NULL_FIELD = struct.pack('>i', -1)
+INT4_FIELD = struct.Struct('>ii')
+INT8_FIELD = struct.Struct('>iq')
+FLOAT4_FIELD = struct.Struct('>if')
+BOOL_FIELD = struct.Struct('>i?')
+LENGTH = struct.Struct('>i')
+
+TEXT_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                             '\r': '\\r'})
+
+
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def text_buffer(rows):
+    """ Return buffer of rows in COPY text format """
+    lines = []
+    for row in rows:
+        fields = []
+        for value in row:
+            if value == None:
+                fields.append('\\N')
+            elif isinstance(value, bool):
+                fields.append('t' if value else 'f')
+            else:
+                fields.append(str(value).translate(TEXT_ESCAPE))
+        lines.append('\t'.join(fields))
+    lines.append('')
+    return io.StringIO('\n'.join(lines))
+
+
+def binary_buffer(rows, types):
+    """ Return buffer of rows in COPY binary format
+        Arguments:
+        - rows: [(...), ]
+        - types: column types, timestamp, text, int4, int8, float4 or bool
+    """
+    data = [BINARY_HEADER]
+    field_count = FIELD_COUNT.pack(len(types))
+    for row in rows:
+        data.append(field_count)
+        for value, type in zip(row, types):
+            if value == None:
+                data.append(NULL_FIELD)
+            elif type == 'timestamp':
+                delta = to_datetime(value) - PG_EPOCH
+                microseconds = (delta.days * 86400 + delta.seconds) * \
+                    1000000 + delta.microseconds
+                data.append(INT8_FIELD.pack(8, microseconds))
+            elif type == 'text':
+                value = value.encode('utf-8')
+                data.append(LENGTH.pack(len(value)))
+                data.append(value)
+            elif type == 'int4':
+                data.append(INT4_FIELD.pack(4, int(value)))
+            elif type == 'int8':
+                data.append(INT8_FIELD.pack(8, int(value)))
+            elif type == 'float4':
+                data.append(FLOAT4_FIELD.pack(4, float(value)))
+            elif type == 'bool':
+                data.append(BOOL_FIELD.pack(1, bool(value)))
+            else:
+                raise Exception(f'unsupported copy type {type}.')
+    data.append(BINARY_TRAILER)
+    return io.BytesIO(b''.join(data))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from threading import Thread
+from queue import Queue, Empty
+
+from pykafka.exceptions import SocketDisconnectedError
+
+from common.record import decode_result, TIMING_PHASES
+from common.metrics import REGISTRY, SIZE_BUCKETS
+
+MAX_RETRY_DELAY = 30  # seconds between retries of failed flush
+
+
+def timing_values(result):
+    """ Return phase timings of result, NULL when not measured """
+    timings = result.get('timings')
+    if timings == None:
+        return (None,) * len(TIMING_PHASES)
+    return tuple(timings.get(phase) for phase in TIMING_PHASES)
+
+
+class WriterPipeline():
+    """ Consume, decode and flush results in separate stages.
+        Stages are connected by bounded queues, so consuming stops when
+        database falls behind. Partition offsets are stored in the same
+        transaction as results, after the batch is flushed.
+        Arguments:
+        - get_consumer: function returning a new topic consumer positioned
+                        after given {partition id: last consumed offset}
+        - db: PostgreSQL
+        - topic_name: topic name of offsets in database
+        - db_offsets: {partition id: offset of last message stored}
+        - websites: {name: id} cache of websites in database
+        - missing_urls: names of websites stored without url, their url is
+                        stored when a result includes it
+        - max_rows: flush when this many rows are buffered
+        - max_latency: flush when oldest buffered row is this many seconds
+        - queue_size: maximum items between stages
+        - catch_up_offsets: {partition id: latest offset at start} to log
+                            time taken to consume backlog
+    """
+    def __init__(self, get_consumer, db, topic_name, db_offsets, websites, log,
+                 max_rows=1000, max_latency=1.0, queue_size=10000,
+                 catch_up_offsets=None, missing_urls=None):
+        self.get_consumer = get_consumer
+        self.db = db
+        self.topic_name = topic_name
+        self.db_offsets = db_offsets
+        # offset of last message passed to decode stage
+        self.consumed_offsets = dict(db_offsets)
+        self.catch_up_offsets = dict(catch_up_offsets or {})
+        self.start_time = time.monotonic()
+        self.websites = websites
+        self.missing_urls = missing_urls if missing_urls != None else set()
+        self.log = log
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.message_queue = Queue(queue_size)  # (partition, offset, value)
+        self.row_queue = Queue(queue_size)  # (partition, offset, result)
+        self.threads = []
+        self.stop_flag = False
+        self.consumed = REGISTRY.counter('writer_consumed_total',
+                                         'messages consumed from kafka')
+        self.invalid = REGISTRY.counter('writer_invalid_message_total',
+                                        'messages skipped as invalid')
+        self.written = REGISTRY.counter('writer_rows_written_total',
+                                        'results written to database')
+        self.retries = REGISTRY.counter('writer_flush_retry_total',
+                                        'batch writes retried')
+        self.batch_rows = REGISTRY.histogram('writer_batch_rows',
+                                             'results in one batch write',
+                                             SIZE_BUCKETS)
+        self.commit_time = REGISTRY.histogram('writer_commit_seconds',
+                                              'time taken to write and '
+                                              'commit one batch')
+
+    def lag(self, latest_offsets):
+        """ Return messages not consumed yet of partitions consumed by
+            this pipeline
+            Arguments:
+            - latest_offsets: {partition id: next offset of partition}
+        """
+        lag = 0
+        for partition, offset in list(self.consumed_offsets.items()):
+            if partition in latest_offsets:
+                lag += max(latest_offsets[partition] - offset - 1, 0)
+        return lag
+
+    def start(self):
+        for target in (self.consume, self.decode, self.run):
+            thread = Thread(target=self._stage, args=(target,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _stage(self, target):
+        """ Run stage until stopped, a stage failing with unexpected error
+            is logged and ends, the owner process checks alive() and exits,
+            so messages of the stage are consumed again after restart
+        """
+        try:
+            target()
+        except Exception as e:
+            self.log.error(f'writer stage {target.__name__} failed. {e}')
+
+    def alive(self):
+        """ Return False when a stage ended before stop """
+        return all(thread.is_alive() for thread in self.threads)
+
+    def stop(self):
+        self.stop_flag = True
+
+    def consume(self):
+        for partition, latest in list(self.catch_up_offsets.items()):
+            self.log.info(f'resume partition {partition} after offset '
+                          f'{self.consumed_offsets.get(partition, -1)}, '
+                          f'latest offset {latest}')
+            self.check_catch_up(partition, self.consumed_offsets.get(
+                partition, -1))
+        consumer = self.get_consumer(dict(self.consumed_offsets))
+        while not self.stop_flag:
+            try:
+                message = consumer.consume()
+            except SocketDisconnectedError as e:
+                # handling connection loss
+                self.log.warning(f'consumer socket disconnect. {e}')
+                consumer = self.reconnect()
+                continue
+            except Exception as e:
+                self.log.warning(f'consumer exception occur. {e}')
+                time.sleep(1)
+                continue
+            if message == None:
+                continue
+            partition = message.partition_id
+            if message.offset <= self.consumed_offsets.get(partition, -1):
+                continue  # already consumed
+            self.message_queue.put((partition, message.offset,
+                                    message.value))
+            self.consumed.inc()
+            self.consumed_offsets[partition] = message.offset
+            if partition in self.catch_up_offsets:
+                self.check_catch_up(partition, message.offset)
+
+    def reconnect(self):
+        """ Return new consumer after last consumed offsets, retry with
+            backoff while transport is down, None when stopped
+        """
+        delay = 1
+        while not self.stop_flag:
+            time.sleep(delay)
+            try:
+                return self.get_consumer(dict(self.consumed_offsets))
+            except Exception as e:
+                self.log.warning(f'unable to reconnect consumer, retry in '
+                                 f'{delay} seconds. {e}')
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        return None
+
+    def check_catch_up(self, partition, offset):
+        latest = self.catch_up_offsets[partition]
+        if offset + 1 >= latest:
+            elapsed = time.monotonic() - self.start_time
+            self.log.info(f'partition {partition} caught up to offset '
+                          f'{latest} in {elapsed:.3f} seconds')
+            del self.catch_up_offsets[partition]
+
+    def decode(self):
+        while not self.stop_flag:
+            try:
+                partition, offset, value = self.message_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if offset <= self.db_offsets.get(partition, -1):
+                continue  # already stored in database
+            try:
+                result = decode_result(value)
+            except Exception as e:
+                self.log.warning(f'skip invalid message, offset={offset}. {e}')
+                self.invalid.inc()
+                result = None
+            self.row_queue.put((partition, offset, result))
+
+    def run(self):
+        """ Flush stage, run until stopped """
+        try:
+            self._run()
+        finally:
+            self.db.release()  # database object is shared by pipelines
+
+    def _run(self):
+        results = []
+        offsets = dict()  # {partition: offset of last message in batch}
+        deadline = None
+        while not self.stop_flag:
+            timeout = 0.5
+            if deadline != None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                partition, offset, result = self.row_queue.get(
+                    timeout=timeout)
+                offsets[partition] = offset
+                if deadline == None:
+                    deadline = time.monotonic() + self.max_latency
+                if result != None:
+                    results.append(result)
+                if len(results) < self.max_rows and \
+                        time.monotonic() < deadline:
+                    continue
+            except Empty:
+                if deadline == None or time.monotonic() < deadline:
+                    continue
+            self.flush(results, offsets)
+            results = []
+            offsets = dict()
+            deadline = None
+
+    def flush(self, results, offsets):
+        """ Write results and offset to database, retry until stored.
+            Results the database rejects are logged and skipped instead of
+            retried, so the offset still advances
+        """
+        # {name: url} of websites not in cache or stored without url,
+        # binary records include url only from time to time
+        unknown = dict()
+        for result in results:
+            name, url = result['name'], result['url']
+            if name in self.websites and \
+                    (not url or name not in self.missing_urls):
+                continue
+            if url or not unknown.get(name):
+                unknown[name] = url  # never replace url by None
+        invalid = []  # names of websites database rejects
+        while unknown:
+            ids = self.db.add_websites(unknown, invalid=invalid)
+            if ids != False:
+                self.log.info(f'add new websites {ids}')
+                self.websites.update(ids)
+                for name in ids:
+                    if unknown[name]:
+                        self.missing_urls.discard(name)
+                    else:
+                        self.missing_urls.add(name)
+                break
+            self.log.warning(f'unable to add websites, retry.')
+            del invalid[:]
+            time.sleep(1)
+        if invalid:
+            self.missing_urls.difference_update(invalid)  # url rejected
+            skipped = [result for result in results
+                       if result['name'] not in self.websites]
+            for result in skipped:
+                self.log.warning(f'skip result of invalid website {result}')
+            self.invalid.inc(len(skipped))
+            results = [result for result in results
+                       if result['name'] in self.websites]
+        rows = [(result['created_at'], self.websites[result['name']],
+                 result['status_code'], result['response_time'],
+                 result['content_check']) for result in results]
+        if self.db.timings:
+            rows = [row + timing_values(result)
+                    for row, result in zip(rows, results)]
+        self.log.debug(f'write {len(rows)} new results to database.')
+        self.batch_rows.observe(len(rows))
+        delay = 1
+        while True:
+            invalid = []  # rows database rejects
+            start = time.monotonic()
+            if self.db.add_check_results(rows, self.topic_name, offsets,
+                                         invalid=invalid) == True:
+                self.commit_time.observe(time.monotonic() - start)
+                break
+            # consuming stops while queues are full, nothing is lost
+            self.log.warning(f'unable to write results, retry in {delay} '
+                             f'seconds.')
+            self.retries.inc()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+        for row in invalid:
+            self.log.warning(f'skip invalid result {row}')
+        self.invalid.inc(len(invalid))
+        self.written.inc(len(rows) - len(invalid))
+        self.db_offsets.update(offsets)
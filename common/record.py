@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import json
+import struct
+import zlib
+
+from datetime import datetime
+
+# binary record, version 1
+#   header: version, flags, site id, created at (epoch seconds),
+#           response time (microseconds), status code
+#   name: length (1 byte) + utf-8 bytes
+#   url: length (2 bytes) + utf-8 bytes, only when FLAG_URL is set
+#   timings: dns, connect, tls, ttfb, transfer (microseconds), only when
+#            FLAG_TIMINGS is set
+VERSION = 1
+HEADER = struct.Struct('>BBIIIH')
+NAME_LENGTH = struct.Struct('>B')
+URL_LENGTH = struct.Struct('>H')
+MAX_NAME_BYTES = 0xff  # longest utf-8 name of binary record
+MAX_URL_BYTES = 0xffff  # longest utf-8 url of binary record
+TIMINGS = struct.Struct('>IIIII')
+
+FLAG_CONTENT_CHECK = 0x01  # pattern found
+FLAG_TRUNCATED = 0x02  # body size limit reached before pattern found
+FLAG_CONTENT_STATUS = 0x04  # content status is known
+FLAG_URL = 0x08  # url is included
+FLAG_CACHE_HIT = 0x10  # not modified, content status of previous check
+FLAG_TIMINGS = 0x20  # phase timings are included
+
+TIMING_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+
+URL_INTERVAL = 300  # seconds between sending url of a website again
+
+MAX_RESPONSE_TIME_US = 0xffffffff
+
+# fields every json record has, and their types after decoding
+JSON_FIELDS = {
+    'name': str,
+    'url': (str, type(None)),
+    'created_at': str,
+    'response_time': float,
+    'status_code': int,
+    'content_check': bool,
+}
+
+
+def site_id(name):
+    """ Stable 32-bit id of website name """
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def result_key(value):
+    """ Return partition key of record, json and binary records of one
+        website have the same key
+    """
+    if value[0] == VERSION:
+        return value[2:6]  # site id
+    name = json.loads(value.decode('utf-8'))['name']
+    return struct.pack('>I', site_id(name))
+
+
+def result_state(value):
+    """ Return (status code, content check, url included) of record,
+        a result may replace a queued result of its website with the
+        same state
+    """
+    if value[0] == VERSION:
+        version, flags, sid, created_at, response_time_us, status_code = \
+            HEADER.unpack_from(value)
+        return (status_code, bool(flags & FLAG_CONTENT_CHECK),
+                bool(flags & FLAG_URL))
+    result = json.loads(value.decode('utf-8'))
+    return result['status_code'], result['content_check'], True
+
+
+def make_result(name, url, start_time, response_time, status_code,
+                content_check, content_status=None, format='json',
+                with_url=True, cache_hit=False, timings=None):
+    """ Build check result record forwarded to kafka
+        Arguments:
+        - format: json or binary
+        - with_url: include url in binary record
+        - cache_hit: content status was reused from previous check
+        - timings: {phase: seconds} of dns, connect, tls, ttfb and transfer
+    """
+    if format == 'binary':
+        return encode_binary(name, url, start_time, response_time,
+                             status_code, content_check, content_status,
+                             with_url=with_url, cache_hit=cache_hit,
+                             timings=timings)
+    time_tuple = time.localtime(start_time)
+    created_at = time.strftime("%Y-%m-%d %H:%M:%S", time_tuple)
+    result = {
+        'name': name,
+        'url': url,
+        'created_at': created_at,
+        'response_time': f'{response_time:.3f}',
+        'status_code': status_code,
+        'content_check': content_check,
+    }
+    if content_status != None:
+        result['content_status'] = content_status
+    if cache_hit:
+        result['cache_hit'] = True
+    if timings != None:
+        result['timings'] = {phase: round(timings[phase], 6)
+                             for phase in TIMING_PHASES}
+    return json.dumps(result).encode('utf-8')
+
+
+def encode_binary(name, url, start_time, response_time, status_code,
+                  content_check, content_status=None, with_url=True,
+                  cache_hit=False, timings=None):
+    flags = 0
+    if content_check:
+        flags |= FLAG_CONTENT_CHECK
+    if content_status != None:
+        flags |= FLAG_CONTENT_STATUS
+        if content_status == 'truncated':
+            flags |= FLAG_TRUNCATED
+    if with_url:
+        flags |= FLAG_URL
+    if cache_hit:
+        flags |= FLAG_CACHE_HIT
+    if timings != None:
+        flags |= FLAG_TIMINGS
+    response_time_us = min(int(response_time * 1000000), MAX_RESPONSE_TIME_US)
+    name_bytes = name.encode('utf-8')
+    if len(name_bytes) > MAX_NAME_BYTES:
+        raise ValueError(f'website name longer than {MAX_NAME_BYTES} bytes')
+    data = [HEADER.pack(VERSION, flags, site_id(name), int(start_time),
+                        response_time_us, status_code),
+            NAME_LENGTH.pack(len(name_bytes)), name_bytes]
+    if with_url:
+        url_bytes = url.encode('utf-8')
+        if len(url_bytes) > MAX_URL_BYTES:
+            raise ValueError(f'url longer than {MAX_URL_BYTES} bytes')
+        data.append(URL_LENGTH.pack(len(url_bytes)))
+        data.append(url_bytes)
+    if timings != None:
+        data.append(TIMINGS.pack(*[
+            min(int(timings[phase] * 1000000), MAX_RESPONSE_TIME_US)
+            for phase in TIMING_PHASES]))
+    return b''.join(data)
+
+
+def decode_result(value):
+    """ Decode binary or json record to dict
+        created_at is datetime for binary record and string for json record,
+        url is None when binary record does not include it, timings is None
+        when record does not include them.
+        Raise ValueError when json record misses a field or has a field of
+        wrong type.
+    """
+    if value[0] != VERSION:
+        result = json.loads(value.decode('utf-8'))
+        if not isinstance(result, dict):
+            raise ValueError(f'record is not an object')
+        for key, types in JSON_FIELDS.items():
+            if key not in result:
+                raise ValueError(f'record misses {key}')
+            if key == 'response_time' and \
+                    isinstance(result[key], (str, int, float)):
+                result[key] = float(result[key])  # string of old checkers
+            if not isinstance(result[key], types):
+                raise ValueError(f'invalid {key} {result[key]!r}')
+        # raise ValueError unless database accepts it as timestamp
+        datetime.strptime(result['created_at'], '%Y-%m-%d %H:%M:%S')
+        result.setdefault('timings', None)
+        return result
+    version, flags, sid, created_at, response_time_us, status_code = \
+        HEADER.unpack_from(value)
+    offset = HEADER.size
+    name_length = value[offset]
+    offset += 1
+    name = value[offset:offset + name_length].decode('utf-8')
+    offset += name_length
+    url = None
+    if flags & FLAG_URL:
+        url_length, = URL_LENGTH.unpack_from(value, offset)
+        offset += URL_LENGTH.size
+        url = value[offset:offset + url_length].decode('utf-8')
+        offset += url_length
+    timings = None
+    if flags & FLAG_TIMINGS:
+        timings = {phase: us / 1000000 for phase, us in
+                   zip(TIMING_PHASES, TIMINGS.unpack_from(value, offset))}
+    content_status = None
+    if flags & FLAG_CONTENT_STATUS:
+        if flags & FLAG_CONTENT_CHECK:
+            content_status = 'found'
+        elif flags & FLAG_TRUNCATED:
+            content_status = 'truncated'
+        else:
+            content_status = 'not_found'
+    return {
+        'site_id': sid,
+        'name': name,
+        'url': url,
+        'created_at': datetime.fromtimestamp(created_at),
+        'response_time': response_time_us / 1000000,
+        'status_code': status_code,
+        'content_check': bool(flags & FLAG_CONTENT_CHECK),
+        'content_status': content_status,
+        'cache_hit': bool(flags & FLAG_CACHE_HIT),
+        'timings': timings,
+    }
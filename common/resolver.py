@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ipaddress
+import socket
+import time
+
+from threading import Thread, Lock
+
+from common.metrics import REGISTRY
+from common.timing import mark
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+        return True
+    except ValueError:
+        return False
+
+
+def lookup_ttl(host, default):
+    """ Return TTL of address record of host, default when unknown.
+        TTL is only known when dnspython is installed.
+    """
+    try:
+        import dns.resolver  # optional, system resolver does not give ttl
+    except ImportError:
+        return default
+    try:
+        answer = dns.resolver.resolve(host, 'A', raise_on_no_answer=False)
+        if answer.rrset == None:
+            answer = dns.resolver.resolve(host, 'AAAA')
+        return answer.rrset.ttl
+    except Exception:
+        return default
+
+
+class DnsCache():
+    """ Cache addresses of hosts for their TTL, limited to min_ttl and
+        max_ttl. Entries used recently are resolved again in background
+        before they expire, so checks do not wait for resolver. If a
+        refresh fails, the old addresses are kept for min_ttl more.
+        Arguments:
+        - min_ttl: minimum seconds to cache addresses
+        - max_ttl: maximum seconds to cache addresses
+        - refresh: resolve used entries in background before they expire
+    """
+    def __init__(self, log, min_ttl=30, max_ttl=300, refresh=True):
+        self.log = log
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.refresh = refresh
+        # (host, port, family): [addrinfo list, expire time, last used]
+        self.entries = dict()
+        self.lock = Lock()
+        self.stop_flag = False
+        self.hits = REGISTRY.counter('checker_dns_cache_hit_total',
+                                     'host lookups answered from dns cache')
+        self.misses = REGISTRY.counter('checker_dns_cache_miss_total',
+                                       'host lookups sent to resolver')
+        REGISTRY.gauge('checker_dns_cache_hit_ratio',
+                       'dns cache hits of all lookups').set_function(
+            self.hit_ratio)
+        if refresh:
+            Thread(target=self._refresh_loop, daemon=True).start()
+
+    def hit_ratio(self):
+        total = self.hits.value + self.misses.value
+        return self.hits.value / total if total else 0
+
+    def _lookup(self, host, port, family):
+        infos = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+        ttl = lookup_ttl(host, self.min_ttl)
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        return infos, time.monotonic() + ttl
+
+    def resolve(self, host, port=0, family=socket.AF_UNSPEC):
+        """ Return getaddrinfo() result of host from cache or resolver """
+        key = (host, port, family)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[1] > now:
+                entry[2] = now
+                self.hits.inc()
+                return entry[0]
+        self.misses.inc()
+        infos, expire = self._lookup(host, port, family)
+        with self.lock:
+            self.entries[key] = [infos, expire, now]
+        return infos
+
+    def _refresh_loop(self):
+        while not self.stop_flag:
+            time.sleep(1)
+            now = time.monotonic()
+            with self.lock:
+                entries = list(self.entries.items())
+            for key, (infos, expire, used) in entries:
+                if now - used > self.max_ttl:
+                    with self.lock:  # not used for a while
+                        self.entries.pop(key, None)
+                    continue
+                if expire - now > max(self.min_ttl / 10, 1):
+                    continue
+                host, port, family = key
+                try:
+                    infos, expire = self._lookup(host, port, family)
+                except Exception as e:
+                    self.log.warning(f'unable to refresh address of {host}, '
+                                     f'keep cached address. {e}')
+                    expire = now + self.min_ttl
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if entry != None:
+                        entry[0] = infos
+                        entry[1] = expire
+
+    def stop(self):
+        self.stop_flag = True
+
+
+def connect(infos, timeout=None, source_address=None, socket_options=None):
+    """ Connect to first reachable address of getaddrinfo() result """
+    error = OSError('no address to connect')
+    for family, type, proto, canonname, address in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, type, proto)
+            for option in socket_options or []:
+                sock.setsockopt(*option)
+            if timeout != None:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            error = e
+            if sock != None:
+                sock.close()
+    raise error
+
+
+def connection_classes(dns_cache=None):
+    """ Return urllib3 (http pool class, https pool class) resolving hosts
+        with dns cache, or system resolver when None, and marking phase
+        times of checks
+    """
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from urllib3.exceptions import NameResolutionError, ConnectTimeoutError
+    from urllib3.exceptions import NewConnectionError
+    from urllib3.util.timeout import _DEFAULT_TIMEOUT
+
+    class CheckConnection():
+        def connect(self):
+            mark('connect_start')
+            super().connect()
+            mark('connected')
+
+        def _new_conn(self):
+            host = self._dns_host.rstrip('.')
+            if is_ip_address(host) or self._tunnel_host != None:
+                sock = super()._new_conn()
+                mark('tcp_end')
+                return sock
+            mark('dns_start')
+            try:
+                if dns_cache != None:
+                    infos = dns_cache.resolve(host, self.port)
+                else:
+                    infos = socket.getaddrinfo(host, self.port, 0,
+                                               socket.SOCK_STREAM)
+            except socket.gaierror as e:
+                raise NameResolutionError(self.host, self, e) from e
+            mark('dns_end')
+            timeout = self.timeout
+            if timeout is _DEFAULT_TIMEOUT:
+                timeout = socket.getdefaulttimeout()
+            try:
+                sock = connect(infos, timeout=timeout,
+                               source_address=self.source_address,
+                               socket_options=self.socket_options)
+            except socket.timeout as e:
+                raise ConnectTimeoutError(
+                    self, f'Connection to {self.host} timed out. '
+                    f'(connect timeout={self.timeout})') from e
+            except OSError as e:
+                raise NewConnectionError(
+                    self, f'Failed to establish a new connection: {e}') from e
+            mark('tcp_end')
+            return sock
+
+    class CheckHTTPConnection(CheckConnection, HTTPConnection):
+        pass
+
+    class CheckHTTPSConnection(CheckConnection, HTTPSConnection):
+        pass
+
+    class CheckHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CheckHTTPConnection
+
+    class CheckHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CheckHTTPSConnection
+
+    return CheckHTTPConnectionPool, CheckHTTPSConnectionPool
+
+
+def get_resolver(dns_cache):
+    """ Return aiohttp resolver using dns cache """
+    import asyncio
+    from aiohttp.abc import AbstractResolver  # only required in async mode
+
+    class CachedResolver(AbstractResolver):
+        async def resolve(self, host, port=0, family=socket.AF_INET):
+            key = (host, port, family)
+            entry = dns_cache.entries.get(key)
+            if entry != None and entry[1] > time.monotonic():
+                infos = dns_cache.resolve(host, port, family)  # cache hit
+            else:
+                loop = asyncio.get_running_loop()
+                infos = await loop.run_in_executor(
+                    None, dns_cache.resolve, host, port, family)
+            hosts = []
+            for family, type, proto, canonname, address in infos:
+                hosts.append({
+                    'hostname': host,
+                    'host': address[0],
+                    'port': address[1],
+                    'family': family,
+                    'proto': proto,
+                    'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+                })
+            return hosts
+
+        async def close(self):
+            pass
+
+    return CachedResolver()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from collections import deque, OrderedDict
+from queue import Empty, Full
+from threading import Lock, Condition
+
+from common.metrics import REGISTRY
+from common.record import result_key, result_state
+
+POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+class ResultQueue():
+    """ Queue of check results waiting for producer, keyed by website.
+        Policies when producer falls behind:
+        - block: put waits while queue is full, results are delivered in
+                 order, like Queue
+        - drop_oldest: put never waits, oldest result is dropped when queue
+                       is full
+        - coalesce: put never waits, queued result of a website is replaced
+                    by its next result with the same state, so status
+                    changes are kept. Over max_per_site results of a
+                    website, results between two of the same state are
+                    merged into the later one, so a flapping website keeps
+                    its first and latest states
+        With drop_oldest and coalesce, website with the latest result is
+        delivered first, results of one website stay in order.
+        Arguments:
+        - maxsize: maximum queued results
+        - policy: block, drop_oldest or coalesce
+        - max_per_site: maximum queued results of a website in coalesce mode
+    """
+    def __init__(self, maxsize=3000, policy='block', max_per_site=4):
+        if policy not in POLICIES:
+            raise Exception(f'unknown queue policy {policy}.')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_per_site = max_per_site
+        self.fifo = deque()  # results in block mode
+        # {key: deque of (state, result)}, website put last is last
+        self.sites = OrderedDict()
+        self.count = 0
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        self.dropped = REGISTRY.counter('checker_queue_dropped_total',
+                                        'results dropped from full queue')
+        self.coalesced = REGISTRY.counter('checker_queue_coalesced_total',
+                                          'results replaced by next result '
+                                          'of same website')
+
+    def qsize(self):
+        return self.count
+
+    def put(self, result, block=True, timeout=None):
+        with self.lock:
+            if self.policy == 'block':
+                deadline = None
+                if timeout != None:
+                    deadline = time.monotonic() + timeout
+                while self.count >= self.maxsize:
+                    remaining = None
+                    if deadline != None:
+                        remaining = deadline - time.monotonic()
+                    if not block or (remaining != None and remaining <= 0):
+                        raise Full
+                    self.not_full.wait(remaining)
+                self.fifo.append(result)
+                self.count += 1
+            else:
+                self._put_keyed(result)
+            self.not_empty.notify()
+
+    def put_nowait(self, result):
+        self.put(result, block=False)
+
+    def _put_keyed(self, result):
+        key = result_key(result)
+        pending = self.sites.get(key)
+        if pending == None:
+            pending = self.sites[key] = deque()
+        else:
+            self.sites.move_to_end(key)
+        state = None
+        if self.policy == 'coalesce':
+            state = result_state(result)
+            if pending and pending[-1][0] == state:
+                pending[-1] = (state, result)
+                self.coalesced.inc()
+                return
+        pending.append((state, result))
+        self.count += 1
+        if self.policy == 'coalesce' and len(pending) > self.max_per_site:
+            self._merge(pending)
+        while self.count > self.maxsize:
+            # oldest result of website put least recently
+            key, oldest = next(iter(self.sites.items()))
+            oldest.popleft()
+            self.count -= 1
+            self.dropped.inc()
+            if not oldest:
+                del self.sites[key]
+
+    def _merge(self, pending):
+        """ Merge oldest run of results from one state back to the same
+            state into its last result. Results of distinct states are all
+            kept, there are only a few of them.
+        """
+        first = dict()  # {state: index of its first result}
+        for index, (state, result) in enumerate(pending):
+            if state in first:
+                start = first[state]
+                merged = index - start
+                for i in range(merged):
+                    del pending[start]
+                self.count -= merged
+                self.coalesced.inc(merged)
+                return
+            first[state] = index
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            deadline = None
+            if timeout != None:
+                deadline = time.monotonic() + timeout
+            while self.count == 0:
+                remaining = None
+                if deadline != None:
+                    remaining = deadline - time.monotonic()
+                if not block or (remaining != None and remaining <= 0):
+                    raise Empty
+                self.not_empty.wait(remaining)
+            if self.policy == 'block':
+                result = self.fifo.popleft()
+            else:
+                key = next(reversed(self.sites))  # latest website first
+                pending = self.sites[key]
+                state, result = pending.popleft()
+                if not pending:
+                    del self.sites[key]
+            self.count -= 1
+            self.not_full.notify()
+            return result
+
+    def get_nowait(self):
+        return self.get(block=False)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+
+from common.pgcopy import to_datetime
+
+# rollup table name and bucket size in seconds
+ROLLUPS = (('status_rollup_1m', 60), ('status_rollup_1h', 3600))
+
+# response time sketch, bucket 0 is below 1 ms and every next bucket
+# doubles the upper bound every two buckets, the last one is unbounded
+SKETCH_SIZE = 40
+SKETCH_BASE = 0.001
+
+
+def sketch_index(response_time):
+    if response_time < SKETCH_BASE:
+        return 0
+    index = int(math.log2(response_time / SKETCH_BASE) * 2) + 1
+    return min(index, SKETCH_SIZE - 1)
+
+
+def sketch_upper_bound(index):
+    return SKETCH_BASE * 2 ** (index / 2)
+
+
+def percentile(sketch, q):
+    """ Return approximate q (0-100) percentile response time in seconds
+        from sketch, upper bound of the bucket containing it
+    """
+    total = sum(sketch)
+    if total == 0:
+        return None
+    rank = total * q / 100
+    count = 0
+    for index, value in enumerate(sketch):
+        count += value
+        if count >= rank:
+            return sketch_upper_bound(index)
+    return sketch_upper_bound(SKETCH_SIZE - 1)
+
+
+def bucket_start(created_at, seconds):
+    created_at = to_datetime(created_at)
+    if seconds == 3600:
+        return created_at.replace(minute=0, second=0, microsecond=0)
+    return created_at.replace(second=0, microsecond=0)
+
+
+def aggregate(results, seconds):
+    """ Aggregate results per website and time bucket
+        Arguments:
+        - results: [(created_at, website_id, status_code, response_time,
+                     content_check), ]
+        - seconds: bucket size, 60 or 3600
+        Return [(website_id, bucket, count, success count, content check
+                 failure count, min, max, sum of response time, sketch), ]
+    """
+    rollups = dict()
+    for row in results:
+        # timing columns may follow
+        created_at, website_id, status_code, response_time, content_check = \
+            row[:5]
+        key = (website_id, bucket_start(created_at, seconds))
+        rollup = rollups.get(key)
+        if rollup == None:
+            rollup = [0, 0, 0, response_time, response_time, 0.0,
+                      [0] * SKETCH_SIZE]
+            rollups[key] = rollup
+        rollup[0] += 1
+        if status_code < 400:
+            rollup[1] += 1
+        if not content_check:
+            rollup[2] += 1
+        rollup[3] = min(rollup[3], response_time)
+        rollup[4] = max(rollup[4], response_time)
+        rollup[5] += response_time
+        rollup[6][sketch_index(response_time)] += 1
+    # sorted to lock rows in the same order in parallel writers
+    return [key + tuple(rollup) for key, rollup in sorted(rollups.items())]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import random
+import time
+
+from common.metrics import REGISTRY
+
+
+class Scheduler():
+    """ Keep next due time of every website in a heap.
+        Next due time is computed from previous due time instead of check
+        finish time, so checking period does not drift with response time.
+        Arguments:
+        - jitter: spread first due time randomly within one interval
+    """
+    def __init__(self, jitter=True):
+        self.jitter = jitter
+        self.heap = []  # [(due, sequence, name), ]
+        self.intervals = dict()  # name: interval
+        self.due = dict()  # name: current due time in heap
+        self.sequence = 0
+        self.lag = REGISTRY.gauge('checker_schedule_lag_seconds',
+                                  'delay between due time and check start')
+        self.lag_max = REGISTRY.gauge('checker_schedule_lag_max_seconds',
+                                      'maximum schedule lag')
+        self.lag_histogram = REGISTRY.histogram(
+            'checker_check_lag_seconds',
+            'distribution of delay between due time and check start')
+        self.missed = REGISTRY.counter('checker_schedule_missed_total',
+                                       'checking periods skipped as '
+                                       'scheduler fell behind')
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _push(self, name, due):
+        self.sequence += 1
+        self.due[name] = due
+        heapq.heappush(self.heap, (due, self.sequence, name))
+
+    def add(self, name, interval, now=None):
+        if now == None:
+            now = time.monotonic()
+        self.intervals[name] = interval
+        if self.jitter:
+            self._push(name, now + random.uniform(0, interval))
+        else:
+            self._push(name, now)
+
+    def remove(self, name):
+        # stale heap entries are skipped when popped
+        self.intervals.pop(name, None)
+        self.due.pop(name, None)
+
+    def update(self, name, interval, now=None):
+        """ Change interval from next check, a check due later than one
+            new interval from now is moved forward
+        """
+        if name not in self.intervals:
+            return
+        if now == None:
+            now = time.monotonic()
+        self.intervals[name] = interval
+        if self.due[name] > now + interval:
+            self._push(name, now + interval)
+
+    def next_due(self):
+        while self.heap:
+            due, sequence, name = self.heap[0]
+            if self.due.get(name) == due:
+                return due
+            heapq.heappop(self.heap)  # drop stale entry
+        return None
+
+    def pop_due(self, now=None):
+        """ Return [(name, due), ] of websites due by now and reschedule them
+        """
+        if now == None:
+            now = time.monotonic()
+        due_list = []
+        while self.heap and self.heap[0][0] <= now:
+            due, sequence, name = heapq.heappop(self.heap)
+            if self.due.get(name) != due:
+                continue  # removed or rescheduled website
+            due_list.append((name, due))
+            interval = self.intervals[name]
+            next_due = due + interval
+            if next_due <= now:  # fell behind, skip missed periods
+                skip = int((now - next_due) // interval) + 1
+                next_due += skip * interval
+                self.missed.inc(skip)
+            self._push(name, next_due)
+        return due_list
+
+    def record_lag(self, due, now=None):
+        if now == None:
+            now = time.monotonic()
+        lag = max(now - due, 0)
+        self.lag.set(lag)
+        self.lag_histogram.observe(lag)
+        if lag > self.lag_max.get():
+            self.lag_max.set(lag)
+        return lag
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ssl
+import time
+import requests
+
+from threading import Lock
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from common.metrics import REGISTRY
+from common.resolver import connection_classes
+from common.timing import mark
+
+
+class TlsSocket(ssl.SSLSocket):
+    """ SSL socket handing its session to context before it is closed """
+    def close(self):
+        if not self._closed and self.server_hostname != None:
+            self.context._take(self.server_hostname, self)
+        super().close()
+
+
+class TlsSessionContext(ssl.SSLContext):
+    """ SSL context offering the last TLS session of a host to its next
+        connection, so the server can resume it with an abbreviated
+        handshake. Session of a connection is taken when it is closed or
+        next connection to the host is made, after the server sent its
+        session ticket. Start of handshake is marked for phase timings.
+    """
+    def setup(self, resume=True):
+        self.resume = resume  # False to only mark handshake start
+        self.sslsocket_class = TlsSocket
+        self.tls_lock = Lock()
+        self.tls_last = dict()  # host: last ssl socket or object
+        self.tls_sessions = dict()  # host: resumable session
+        self.tls_bundles = set()  # (cafile, capath) loaded
+        self.tls_resumed = REGISTRY.counter('checker_tls_resumed_total',
+                                            'tls sessions resumed')
+        self.tls_full = REGISTRY.counter('checker_tls_handshake_total',
+                                         'full tls handshakes')
+
+    def load_bundle(self, cafile=None, capath=None):
+        """ Load ca certificates once """
+        with self.tls_lock:
+            if (cafile, capath) in self.tls_bundles or \
+                    (cafile == None and capath == None):
+                return
+            self.load_verify_locations(cafile, capath)
+            self.tls_bundles.add((cafile, capath))
+
+    def _take(self, host, tls=None):
+        """ Keep session of last connection to host, if tls is given only
+            when it is that connection
+        """
+        with self.tls_lock:
+            last = self.tls_last.get(host)
+            if last == None or (tls != None and last is not tls):
+                return
+            self.tls_last[host] = None
+            try:
+                if last.session_reused:
+                    self.tls_resumed.inc()
+                else:
+                    self.tls_full.inc()
+                session = last.session
+                if session != None and session.has_ticket:
+                    self.tls_sessions[host] = session
+            except Exception:
+                pass  # closed or no handshake
+
+    def _session(self, host):
+        self._take(host)
+        with self.tls_lock:
+            return self.tls_sessions.get(host)
+
+    def _remember(self, host, tls):
+        with self.tls_lock:
+            self.tls_last[host] = tls
+
+    def wrap_socket(self, sock, server_side=False, server_hostname=None,
+                    session=None, **kwargs):
+        mark('tcp_end')
+        if not self.resume or server_side or server_hostname == None or \
+                session != None:
+            return super().wrap_socket(sock, server_side=server_side,
+                                       server_hostname=server_hostname,
+                                       session=session, **kwargs)
+        tls = super().wrap_socket(sock, server_hostname=server_hostname,
+                                  session=self._session(server_hostname),
+                                  **kwargs)
+        self._remember(server_hostname, tls)
+        return tls
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        mark('tcp_end')
+        if not self.resume or server_side or server_hostname == None or \
+                session != None:
+            return super().wrap_bio(incoming, outgoing,
+                                    server_side=server_side,
+                                    server_hostname=server_hostname,
+                                    session=session)
+        tls = super().wrap_bio(incoming, outgoing,
+                               server_hostname=server_hostname,
+                               session=self._session(server_hostname))
+        self._remember(server_hostname, tls)
+        return tls
+
+
+def get_ssl_context(resume=True):
+    """ Return verifying ssl context shared by checks, certificates are
+        loaded once instead of for every connection
+        Arguments:
+        - resume: resume tls sessions of hosts
+    """
+    context = TlsSessionContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.setup(resume=resume)
+    context.load_default_certs()
+    return context
+
+
+class CheckAdapter(HTTPAdapter):
+    """ HTTP adapter resolving hosts with dns cache and sharing ssl context
+        Arguments:
+        - timed: mark connection events for phase timings
+    """
+    def __init__(self, dns_cache=None, ssl_context=None, timed=False,
+                 **kwargs):
+        self.dns_cache = dns_cache
+        self.ssl_context = ssl_context
+        self.timed = timed
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        HTTPAdapter.cert_verify(self, conn, url, verify, cert)
+        if self.ssl_context != None and verify:
+            # urllib3 would load the bundle into shared context again for
+            # every connection
+            self.ssl_context.load_bundle(conn.ca_certs, conn.ca_cert_dir)
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context != None:
+            kwargs['ssl_context'] = self.ssl_context
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        if self.dns_cache != None or self.timed:
+            http_pool, https_pool = connection_classes(self.dns_cache)
+            self.poolmanager.pool_classes_by_scheme = {'http': http_pool,
+                                                       'https': https_pool}
+
+
+class SessionPool():
+    """ Share keep-alive requests sessions between websites on same host.
+        Arguments:
+        - pool_connections: number of connection pools cached per session
+        - pool_maxsize: maximum connections kept alive per host
+        - idle_timeout: close session not used for this many seconds
+        - dns_cache: DnsCache to resolve hosts, None for system resolver
+        - ssl_context: ssl context shared by connections
+        - timed: mark connection events for phase timings
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10, idle_timeout=60,
+                 dns_cache=None, ssl_context=None, timed=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache  # DnsCache, None for system resolver
+        self.ssl_context = ssl_context  # shared context resuming sessions
+        self.timed = timed
+        self.sessions = dict()  # host: [session, last used time]
+        self.lock = Lock()
+        self.evict_time = time.monotonic()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = CheckAdapter(pool_connections=self.pool_connections,
+                               pool_maxsize=self.pool_maxsize,
+                               dns_cache=self.dns_cache,
+                               ssl_context=self.ssl_context,
+                               timed=self.timed)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, url):
+        """ Return session for host of url """
+        parts = urlsplit(url)
+        host = f'{parts.scheme}://{parts.netloc}'
+        now = time.monotonic()
+        with self.lock:
+            if now - self.evict_time > self.idle_timeout:
+                self._evict(now)
+            entry = self.sessions.get(host)
+            if entry == None:
+                entry = [self._new_session(), now]
+                self.sessions[host] = entry
+            entry[1] = now
+            return entry[0]
+
+    def _evict(self, now):
+        self.evict_time = now
+        for host, entry in list(self.sessions.items()):
+            if now - entry[1] > self.idle_timeout:
+                entry[0].close()
+                del self.sessions[host]
+
+    def close(self):
+        with self.lock:
+            for session, last_used in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+def cold_get(url, timed=False, **kwargs):
+    """ Send request on a new connection, including tcp and tls handshake
+        Arguments:
+        - timed: mark connection events for phase timings
+    """
+    headers = kwargs.pop('headers', dict())
+    headers['Connection'] = 'close'
+    if not timed:
+        return requests.get(url, headers=headers, **kwargs)
+    with requests.Session() as session:
+        adapter = CheckAdapter(timed=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session.get(url, headers=headers, **kwargs)
+
+
+def get_connector(limit=100, limit_per_host=10, idle_timeout=60, cold=False,
+                  resolver=None, ssl_context=None):
+    """ Return aiohttp connector shared by sessions of async check engine
+        Arguments:
+        - resolver: aiohttp resolver, None for default resolver and cache
+        - ssl_context: ssl context shared by connections
+    """
+    import aiohttp  # only required in async mode
+
+    options = dict()
+    if ssl_context != None:
+        options['ssl'] = ssl_context
+    if cold:
+        return aiohttp.TCPConnector(limit=limit, force_close=True, **options)
+    if resolver != None:
+        # resolver honours ttl, aiohttp would cache for fixed 10 seconds
+        options['resolver'] = resolver
+        options['use_dns_cache'] = False
+    return aiohttp.TCPConnector(limit=limit,
+                                limit_per_host=limit_per_host,
+                                keepalive_timeout=idle_timeout,
+                                **options)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import hashlib
+
+VNODES = 500  # points of every member on hash ring
+
+
+def hash_key(key):
+    """ Stable 64-bit hash, same value in every process and host """
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class HashRing():
+    """ Consistent hash ring of members. Every member owns VNODES points,
+        a key belongs to the member of the first point after its hash, so
+        adding or removing one of N members moves only about 1/N of keys.
+        Arguments:
+        - members: member names
+        - vnodes: points of every member on ring
+    """
+    def __init__(self, members, vnodes=VNODES):
+        points = []
+        for member in set(members):
+            for i in range(vnodes):
+                points.append((hash_key(f'{member}#{i}'), member))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.members = [point[1] for point in points]
+
+    def owner(self, key):
+        index = bisect.bisect(self.hashes, hash_key(key))
+        if index == len(self.hashes):
+            index = 0  # wrap around
+        return self.members[index]
+
+
+class Shard():
+    """ Websites checked by one checker of a fleet
+        Arguments:
+        - name: member name of this checker
+        - members: member names of all checkers
+    """
+    def __init__(self, name, members):
+        if name not in members:
+            raise Exception(f'shard {name} is not in members {members}.')
+        self.name = name
+        self.members = list(members)
+        self.ring = HashRing(members)
+
+    def __str__(self):
+        return f'{self.name} of {len(self.members)} shards'
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.name
+
+    def select(self, websites):
+        """ Return {name: config} of websites owned by this shard """
+        return {name: config for name, config in websites.items()
+                if self.owns(name)}
+
+
+def index_shard(index, count, prefix='shard'):
+    """ Shard by index, members are named <prefix>-0 to
+        <prefix>-<count - 1>. Nested shards need another prefix, a ring
+        of the same members would give every website of an outer shard
+        to the same inner shard.
+    """
+    if count < 1 or not 0 <= index < count:
+        raise Exception(f'invalid shard index {index} of {count} shards.')
+    return Shard(f'{prefix}-{index}',
+                 [f'{prefix}-{i}' for i in range(count)])
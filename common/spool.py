@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import time
+import zlib
+import struct
+
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+
+from common.metrics import REGISTRY
+
+HEADER = struct.Struct('>II')  # record length, crc32 of record
+POSITION = struct.Struct('>QQ')  # segment id, offset after acked record
+
+
+class Segment():
+    """ Spool file of records, preallocated to size and memory mapped.
+        A record is header followed by value, zero length marks the end.
+        Value is written before header, so a record cut by a crash is not
+        read back.
+    """
+    def __init__(self, path, id, size):
+        self.path = path
+        self.id = id
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.end = 0  # offset of next record
+        self.records = 0
+        self.acked = 0
+
+    def scan(self, acked_offset=0):
+        """ Find end of records written before restart, records before
+            acked_offset were produced already
+        """
+        offset = 0
+        while True:
+            record = self.read(offset)
+            if record == None:
+                break
+            value, offset = record
+            self.records += 1
+            if offset <= acked_offset:
+                self.acked += 1
+        self.end = offset
+
+    def append(self, value):
+        """ Append value, return False when segment is full """
+        start = self.end + HEADER.size
+        if start + len(value) > self.size:
+            return False
+        self.map[start:start + len(value)] = value
+        HEADER.pack_into(self.map, self.end, len(value), zlib.crc32(value))
+        self.end = start + len(value)
+        self.records += 1
+        return True
+
+    def read(self, offset):
+        """ Return (value, offset of next record), None at end """
+        if offset + HEADER.size > self.size:
+            return None
+        length, crc = HEADER.unpack_from(self.map, offset)
+        start = offset + HEADER.size
+        if length == 0 or start + length > self.size:
+            return None
+        value = bytes(self.map[start:start + length])
+        if zlib.crc32(value) != crc:
+            return None
+        return value, start + length
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.unlink(self.path)
+
+
+class Spool():
+    """ Append-only spool of results on disk between checks and producer.
+        Checks append results to memory mapped segment files and never
+        wait for the producer. The producer reads results in order and acks
+        them once delivered. Segments are flushed and the acked position is
+        saved every sync_interval, results not acked are read again after
+        rewind() or restart, so up to sync_interval of produced results may
+        be sent twice after a crash. When spool is full, the oldest segment
+        is dropped.
+        Arguments:
+        - path: spool directory
+        - segment_size: bytes of one segment file
+        - max_size: maximum bytes of all segment files
+        - sync_interval: seconds between flushes to disk
+    """
+    def __init__(self, path, log, segment_size=16 * 1024 * 1024,
+                 max_size=1024 * 1024 * 1024, sync_interval=1):
+        self.path = path
+        self.log = log
+        self.segment_size = segment_size
+        self.max_size = max(max_size, segment_size)
+        self.sync_interval = sync_interval
+        self.ready = Condition()
+        self.segments = []  # oldest first
+        self.unacked = 0  # records read but not acked
+        self.stop_flag = False
+        self.written = REGISTRY.counter('checker_spool_written_total',
+                                        'results appended to spool')
+        self.dropped = REGISTRY.counter('checker_spool_dropped_total',
+                                        'results dropped when spool is full')
+        self.replayed = REGISTRY.counter('checker_spool_replayed_total',
+                                         'results read again from spool')
+        REGISTRY.gauge('checker_spool_depth_records',
+                       'results in spool not produced yet').set_function(
+            self.depth)
+        REGISTRY.gauge('checker_spool_bytes',
+                       'bytes of spool segment files').set_function(
+            self.size)
+        os.makedirs(path, exist_ok=True)
+        self.ack_file = open(os.path.join(path, 'ack'), 'a+b')
+        data = os.pread(self.ack_file.fileno(), POSITION.size, 0)
+        self.acked = POSITION.unpack(data) if len(data) == POSITION.size \
+            else (0, 0)
+        self.synced = self.acked
+        self._load()
+        self.read_position = self.acked
+        if self.depth() > 0:
+            self.log.info(f'replay {self.depth()} spooled results')
+            self.replayed.inc(self.depth())
+        Thread(target=self._sync_loop, daemon=True).start()
+
+    def _segment_path(self, id):
+        return os.path.join(self.path, f'{id:016d}.seg')
+
+    def _load(self):
+        ids = sorted(int(name[:-4]) for name in os.listdir(self.path)
+                     if name.endswith('.seg'))
+        acked_id, acked_offset = self.acked
+        for id in ids:
+            path = self._segment_path(id)
+            if id < acked_id:
+                os.unlink(path)  # produced before restart
+                continue
+            segment = Segment(path, id, self.segment_size)
+            segment.scan(acked_offset if id == acked_id else 0)
+            self.segments.append(segment)
+        if not self.segments:
+            id = max(ids + [acked_id, 0]) + 1
+            self.segments.append(Segment(self._segment_path(id), id,
+                                         self.segment_size))
+        if self.acked[0] < self.segments[0].id:
+            self.acked = (self.segments[0].id, 0)
+
+    def _find(self, id):
+        for segment in self.segments:
+            if segment.id == id:
+                return segment
+        return None
+
+    def depth(self):
+        """ Return results not acked yet """
+        return sum(s.records - s.acked for s in self.segments)
+
+    def size(self):
+        return sum(s.size for s in self.segments)
+
+    def append(self, value):
+        value = bytes(value)
+        with self.ready:
+            if not self.segments[-1].append(value):
+                self._rotate(HEADER.size + len(value))
+                self.segments[-1].append(value)
+            self.written.inc()
+            self.ready.notify()
+
+    def _rotate(self, needed):
+        """ Start next segment, drop oldest segments beyond max_size """
+        last = self.segments[-1]
+        last.flush()
+        size = max(self.segment_size, needed)
+        while self.segments and self.size() + size > self.max_size:
+            segment = self.segments.pop(0)
+            lost = segment.records - segment.acked
+            self.dropped.inc(lost)
+            self.log.warning(f'spool full, drop {lost} results of oldest '
+                             f'segment')
+            if segment.id >= self.read_position[0]:
+                self.unacked = 0
+            segment.remove()
+        id = last.id + 1
+        self.segments.append(Segment(self._segment_path(id), id, size))
+        first = (self.segments[0].id, 0)
+        self.acked = max(self.acked, first)
+        self.read_position = max(self.read_position, first)
+
+    def get(self, timeout=None):
+        """ Return (position, value) of next result, None on timeout """
+        deadline = None if timeout == None else time.monotonic() + timeout
+        with self.ready:
+            while True:
+                record = self._read()
+                if record != None:
+                    self.unacked += 1
+                    return record
+                remaining = None
+                if deadline != None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                self.ready.wait(remaining)
+
+    def _read(self):
+        id, offset = self.read_position
+        segment = self._find(id)
+        if offset < segment.end:
+            value, offset = segment.read(offset)
+            self.read_position = (id, offset)
+            return self.read_position, value
+        if segment is not self.segments[-1]:
+            index = self.segments.index(segment)
+            self.read_position = (self.segments[index + 1].id, 0)
+            return self._read()
+        return None
+
+    def ack(self, position):
+        """ Mark result read at position as produced """
+        with self.ready:
+            segment = self._find(position[0])
+            if segment == None or position <= self.acked:
+                return  # dropped when spool was full
+            segment.acked += 1
+            self.unacked = max(self.unacked - 1, 0)
+            self.acked = position
+            while self.segments[0].id < position[0]:
+                self.segments.pop(0).remove()  # all produced
+
+    def rewind(self):
+        """ Read results not acked again, after producer failed """
+        with self.ready:
+            self.replayed.inc(self.unacked)
+            self.unacked = 0
+            self.read_position = self.acked
+
+    def sync(self):
+        """ Flush segments and save acked position """
+        with self.ready:
+            self.segments[-1].flush()
+            acked = self.acked
+        if acked != self.synced:
+            os.pwrite(self.ack_file.fileno(), POSITION.pack(*acked), 0)
+            os.fsync(self.ack_file.fileno())
+            self.synced = acked
+
+    def _sync_loop(self):
+        while not self.stop_flag:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                self.log.error(f'unable to sync spool. {e}')
+
+    def close(self):
+        self.stop_flag = True
+        self.sync()
+        with self.ready:
+            for segment in self.segments:
+                segment.close()
+        self.ack_file.close()
+
+
+class InFlight():
+    """ Spooled results passed to an async producer and not reported yet.
+        Results are acked in spool order once they and every older result
+        are reported, so a crash never loses a result still queued in the
+        producer. A failed result is spooled again before it is reported.
+    """
+    def __init__(self, spool):
+        self.spool = spool
+        self.positions = OrderedDict()  # {position: reported}, read order
+        self.values = dict()  # {value: deque of positions}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, position, value):
+        self.positions[position] = False
+        self.values.setdefault(bytes(value), deque()).append(position)
+
+    def report(self, value):
+        """ Mark result reported by producer, ack reported results """
+        positions = self.values.get(bytes(value))
+        if not positions:
+            return  # produced before rewind
+        self.positions[positions.popleft()] = True
+        if not positions:
+            del self.values[bytes(value)]
+        while self.positions:
+            position, reported = next(iter(self.positions.items()))
+            if not reported:
+                break
+            self.positions.popitem(last=False)
+            self.spool.ack(position)
+
+    def clear(self):
+        """ Forget results in flight, after spool is rewound """
+        self.positions.clear()
+        self.values.clear()
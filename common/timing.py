@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from contextvars import ContextVar
+
+# timer of check running in current thread or task
+current_timer = ContextVar('current_timer', default=None)
+
+
+def mark(event):
+    """ Mark time of event in timer of current check, if any """
+    timer = current_timer.get()
+    if timer != None:
+        timer.marks[event] = time.monotonic()
+
+
+class PhaseTimer():
+    """ Split time of one check into phases. Connection code marks events
+        with mark(), so it is found through context of the thread or task.
+        Events:
+        - connect_start: new connection started
+        - dns_start, dns_end: host lookup
+        - tcp_end: tcp connected, tls handshake started
+        - connected: connection ready to send request
+        - headers: response headers received
+        Phases of a reused connection are 0 except ttfb and transfer.
+    """
+    def __init__(self):
+        self.marks = dict()
+        self.start = None
+        self.end = None
+        self.token = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.token = current_timer.set(self)
+        return self
+
+    def __exit__(self, *args):
+        current_timer.reset(self.token)
+        if self.end == None:
+            self.end = time.monotonic()
+
+    def mark(self, event):
+        self.marks[event] = time.monotonic()
+
+    def finish(self):
+        self.end = time.monotonic()
+
+    def _span(self, first, last):
+        if first not in self.marks or last not in self.marks:
+            return 0.0
+        return max(self.marks[last] - self.marks[first], 0.0)
+
+    def timings(self):
+        """ Return {phase: seconds} """
+        end = self.end if self.end != None else time.monotonic()
+        tcp_start = 'dns_end' if 'dns_end' in self.marks else 'connect_start'
+        tcp_end = 'tcp_end' if 'tcp_end' in self.marks else 'connected'
+        ready = self.marks.get('connected', self.start)
+        headers = self.marks.get('headers', end)
+        return {
+            'dns': self._span('dns_start', 'dns_end'),
+            'connect': self._span(tcp_start, tcp_end),
+            'tls': self._span('tcp_end', 'connected'),
+            'ttfb': max(headers - ready, 0.0),
+            'transfer': max(end - headers, 0.0),
+        }
+
+
+def get_trace_config():
+    """ Return aiohttp trace config marking events of async checks """
+    import aiohttp  # only required in async mode
+
+    def on(event):
+        async def callback(session, context, params):
+            mark(event)
+        return callback
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on('connect_start'))
+    trace_config.on_dns_resolvehost_start.append(on('dns_start'))
+    trace_config.on_dns_resolvehost_end.append(on('dns_end'))
+    trace_config.on_connection_create_end.append(on('connected'))
+    return trace_config
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import struct
+
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread, Lock
+
+from common.kafka import Kafka, resume_offset
+from common.utils import get_config
+
+LENGTH = struct.Struct('>I')  # length prefix of record on unix socket
+
+
+class Message():
+    """ Record received by a consumer, like a pykafka message """
+    def __init__(self, partition_id, offset, value):
+        self.partition_id = partition_id
+        self.offset = offset
+        self.value = value
+
+
+class KafkaTransport():
+    """ Results through a kafka topic, partitioned by website
+        Arguments:
+        - config: kafka config section
+        - tls: connect kafka with tls
+    """
+    balanced = True  # partitions can be shared by a consumer group
+
+    def __init__(self, config, log, tls=True):
+        self.config = config
+        self.log = log
+        self.tls = tls
+        self.name = config.get('topic')  # topic name stored in database
+        self.sync = config.get('producer', 'sync') != 'async'
+        self.kafka = None
+        self.topic = None
+
+    def __str__(self):
+        return f'kafka topic {self.name}'
+
+    def connect(self):
+        for key in ('host', 'port', 'cafile', 'certfile', 'keyfile', 'topic'):
+            if key not in self.config:
+                raise Exception(f'kafka config missing {key}.')
+        self.kafka = Kafka(self.config['host'],
+                           self.config['port'],
+                           self.config['cafile'],
+                           self.config['certfile'],
+                           self.config['keyfile'],
+                           self.log)
+        if self.kafka.set_client(tls=self.tls) == False:
+            return False
+        self.topic = self.kafka.get_topic(self.name)
+        return self.topic != False
+
+    def get_producer(self):
+        return self.kafka.get_producer(
+            self.topic,
+            sync=self.sync,
+            linger_ms=int(self.config.get('linger_ms', 5000)),
+            batch_size=int(self.config.get('batch_size', 70000)),
+            compression=self.config.get('compression', 'none'),
+            max_in_flight=int(self.config.get('max_in_flight', 100000)))
+
+    def partition_ids(self):
+        return list(self.topic.partitions)
+
+    def latest_offsets(self):
+        """ Return {partition id: next offset of partition} """
+        return {partition_id: partition.latest_available_offset()
+                for partition_id, partition in self.topic.partitions.items()}
+
+    def get_consumer(self, partition_id, offset, group):
+        """ Return consumer of one partition resuming after offset """
+        partition = self.topic.partitions[partition_id]
+        # seek directly to stored offset instead of reading and skipping
+        # stored messages
+        consumer = self.topic.get_simple_consumer(
+            consumer_group=group,
+            partitions=[partition],
+            auto_offset_reset=self.kafka.offset_type.EARLIEST,
+            reset_offset_on_start=False,
+            consumer_timeout_ms=500)
+        consumer.reset_offsets([(partition, resume_offset(offset))])
+        return consumer
+
+    def get_balanced_consumer(self, group, post_rebalance_callback):
+        return self.topic.get_balanced_consumer(
+            consumer_group=group,
+            managed=True,
+            consumer_timeout_ms=500,
+            post_rebalance_callback=post_rebalance_callback)
+
+    def close(self):
+        pass
+
+
+class QueueConsumer():
+    """ Consume records of a local queue as partition 0, numbering them
+        after the offset stored in database, so writer pipeline keeps its
+        batching and offset bookkeeping
+    """
+    def __init__(self, queue, offset):
+        self.queue = queue
+        self.offset = offset  # offset of last record taken
+        self.lock = Lock()
+
+    def next_offset(self):
+        with self.lock:
+            self.offset += 1
+            return self.offset
+
+    def consume(self, timeout=0.5):
+        try:
+            value = self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+        return Message(0, self.next_offset(), value)
+
+
+class LocalProducer():
+    """ Producer putting records into a local queue, blocks when full """
+    def __init__(self, queue):
+        self.queue = queue
+        self.reports = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def produce(self, value, partition_key=None):
+        self.queue.put(bytes(value))
+        self.reports.append((Message(None, None, value), None))
+
+    def get_delivery_report(self, block=False):
+        try:
+            return self.reports.popleft()
+        except IndexError:
+            raise Empty
+
+
+class LocalTransport():
+    """ Results through a queue of one process, checker threads put
+        results directly into queue and writer pipeline consumes it
+        Arguments:
+        - name: topic name of offsets stored in database
+        - queue_size: maximum results in queue
+    """
+    balanced = False
+    sync = False
+
+    def __init__(self, log, name='local', queue_size=10000):
+        self.log = log
+        self.name = name
+        self.queue = Queue(queue_size)
+        self.consumer = None
+
+    def __str__(self):
+        return f'local queue {self.name}'
+
+    def connect(self):
+        return True
+
+    def get_producer(self):
+        return LocalProducer(self.queue)
+
+    def partition_ids(self):
+        return [0]
+
+    def latest_offsets(self):
+        if self.consumer == None:
+            return dict()
+        return {0: self.consumer.offset + 1 + self.queue.qsize()}
+
+    def get_consumer(self, partition_id, offset, group=None):
+        if self.consumer == None:
+            self.consumer = QueueConsumer(self.queue, offset)
+        return self.consumer
+
+    def close(self):
+        pass
+
+
+class UnixSocketProducer():
+    """ Send length prefixed records to writer listening on unix socket.
+        When writer is not reachable, produce retries with backoff, so
+        checks wait in result queue until writer is back.
+    """
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.sock = None
+        self.reports = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def produce(self, value, partition_key=None):
+        value = bytes(value)
+        frame = LENGTH.pack(len(value)) + value
+        delay = 0.1
+        while True:
+            try:
+                if self.sock == None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(self.path)
+                    self.sock = sock
+                self.sock.sendall(frame)
+                self.reports.append((Message(None, None, value), None))
+                return
+            except OSError as e:
+                self.close()
+                self.log.warning(f'unable to send result to {self.path}, '
+                                 f'retry in {delay:.1f} seconds. {e}')
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def get_delivery_report(self, block=False):
+        try:
+            return self.reports.popleft()
+        except IndexError:
+            raise Empty
+
+
+class UnixSocketTransport():
+    """ Results from checkers on the same host through a unix socket.
+        Writer listens on path and numbers received records as partition
+        0 after the offset stored in database. Records sent but not
+        written yet are lost when writer stops.
+        Arguments:
+        - path: unix socket file path
+        - name: topic name of offsets stored in database
+        - queue_size: maximum received results not written yet
+    """
+    balanced = False
+    sync = False
+
+    def __init__(self, path, log, name='local', queue_size=10000):
+        self.path = path
+        self.log = log
+        self.name = name
+        self.queue = Queue(queue_size)
+        self.consumer = None
+        self.server = None
+
+    def __str__(self):
+        return f'unix socket {self.path}'
+
+    def connect(self):
+        return True
+
+    def get_producer(self):
+        return UnixSocketProducer(self.path, self.log)
+
+    def partition_ids(self):
+        return [0]
+
+    def latest_offsets(self):
+        if self.consumer == None:
+            return dict()
+        return {0: self.consumer.offset + 1 + self.queue.qsize()}
+
+    def get_consumer(self, partition_id, offset, group=None):
+        """ Listen on socket once, return consumer of received records """
+        if self.consumer == None:
+            self.consumer = QueueConsumer(self.queue, offset)
+            self._listen()
+        return self.consumer
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left by previous writer
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        self.log.info(f'listen for results on {self.path}')
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return  # closed
+            Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        with conn, conn.makefile('rb') as stream:
+            while True:
+                header = stream.read(LENGTH.size)
+                if len(header) < LENGTH.size:
+                    return  # checker disconnected
+                length, = LENGTH.unpack(header)
+                value = stream.read(length)
+                if len(value) < length:
+                    return
+                # blocks when writer falls behind, checker waits in turn
+                self.queue.put(value)
+
+    def close(self):
+        if self.server != None:
+            self.server.close()
+            self.server = None
+            os.unlink(self.path)
+
+
+def get_transport(config_file, log, tls=True):
+    """ Return transport selected by type in transport config section,
+        kafka by default
+    """
+    config = get_config(config_file, 'transport')
+    type = config.get('type', 'kafka')
+    if type == 'kafka':
+        return KafkaTransport(get_config(config_file, 'kafka'), log, tls=tls)
+    if type == 'unix':
+        return UnixSocketTransport(
+            config.get('path', './monitor.sock'),
+            log,
+            name=config.get('name', 'local'),
+            queue_size=int(config.get('queue_size', 10000)))
+    raise Exception(f'unknown transport type {type}.')
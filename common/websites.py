@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+from common.utils import read_yaml
+from common.record import MAX_NAME_BYTES, MAX_URL_BYTES
+
+
+def parse_websites(data, interval=10, max_body=0):
+    """ Return {name: {url, pattern, interval, cold, max_body}} of websites
+        read from yaml, with defaults filled in
+        Arguments:
+        - data: {name: {url, pattern, ...}} from websites yaml
+        - interval: default check interval in seconds
+        - max_body: default maximum body bytes to scan
+    """
+    websites = dict()
+    for name, info in data.items():
+        for key in ['url', 'pattern']:
+            if key not in info:
+                raise Exception(f'website {name} config missing {key}')
+        # longer names and urls do not fit in binary result record
+        if len(str(name).encode('utf-8')) > MAX_NAME_BYTES:
+            raise Exception(f'website name {name} longer than '
+                            f'{MAX_NAME_BYTES} bytes')
+        if len(str(info['url']).encode('utf-8')) > MAX_URL_BYTES:
+            raise Exception(f'website {name} url longer than '
+                            f'{MAX_URL_BYTES} bytes')
+        websites[name] = {
+            'url': info['url'],
+            'pattern': info['pattern'],
+            'interval': max(float(info.get('interval', interval)), 1),
+            'cold': bool(info.get('cold', False)),
+            'max_body': int(info.get('max_body', max_body)),
+        }
+    return websites
+
+
+def diff_websites(running, websites):
+    """ Compare running websites with new websites
+        Return (added, removed, changed) lists of names
+    """
+    added = [name for name in websites if name not in running]
+    removed = [name for name in running if name not in websites]
+    changed = [name for name, config in websites.items()
+               if name in running and running[name] != config]
+    return added, removed, changed
+
+
+class WebsiteFile():
+    """ Read websites yaml again when its modification time changes
+        Arguments:
+        - path: websites yaml file path
+        - interval: default check interval in seconds
+        - max_body: default maximum body bytes to scan
+        - shard: Shard selecting websites of this checker, None for all
+    """
+    def __init__(self, path, interval=10, max_body=0, shard=None):
+        self.path = path
+        self.interval = interval
+        self.max_body = max_body
+        self.shard = shard
+        self.mtime = None
+        self.total = 0  # websites in file before sharding
+
+    def read(self):
+        self.mtime = os.stat(self.path).st_mtime_ns
+        websites = parse_websites(read_yaml(self.path),
+                                  interval=self.interval,
+                                  max_body=self.max_body)
+        self.total = len(websites)
+        if self.shard != None:
+            websites = self.shard.select(websites)
+        return websites
+
+    def modified(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except OSError:
+            return False  # being replaced, check again later
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing
+
+from common.metrics import REGISTRY
+
+
+class WorkerPool():
+    """ Run worker processes and restart the ones which exit.
+        Workers are started with spawn, so they do not inherit threads and
+        sockets of the supervisor.
+        Arguments:
+        - target: module level function run as target(index, count, *args)
+        - count: number of worker processes
+    """
+    def __init__(self, target, count, log):
+        self.target = target
+        self.count = count
+        self.args = ()
+        self.log = log
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = dict()  # {index: Process}
+        self.restarts = REGISTRY.counter('checker_worker_restart_total',
+                                         'worker processes restarted')
+
+    def queue(self, maxsize=0):
+        """ Return queue shared with worker processes """
+        return self.context.Queue(maxsize)
+
+    def start(self, *args):
+        """ Start workers, args are passed to target and must be picklable
+        """
+        self.args = args
+        for index in range(self.count):
+            self._start(index)
+
+    def _start(self, index):
+        process = self.context.Process(
+            target=self.target,
+            args=(index, self.count) + self.args,
+            name=f'worker-{index}',
+            daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.log.info(f'start worker {index}, pid={process.pid}')
+
+    def check(self):
+        """ Restart workers which exited, call periodically """
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            self.log.warning(f'worker {index} exited with code '
+                             f'{process.exitcode}, restart it.')
+            process.join()
+            self.restarts.inc()
+            self._start(index)
+
+    def signal(self, signum):
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop(self, timeout=5):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout)
+        self.processes = dict()
@@ -7,20 +7,38 @@ import daemon
 import requests
 import re
 import os
+import random
+import signal
 
 from argparse import ArgumentParser
-from threading import Thread
-from queue import Queue
+from threading import Thread, Event
+from queue import Empty
 from datetime import datetime
 
 from common.utils import *
-from common.kafka import Kafka
+from common.kafka import count_delivery_reports
+from common.record import make_result, result_key, URL_INTERVAL
+from common.engine import AsyncCheckEngine
+from common.metrics import REGISTRY, MetricsServer
+from common.session import SessionPool, cold_get, get_ssl_context
+from common.resolver import DnsCache
+from common.content import BodyScanner, ContentCache, compile_pattern
+from common.content import CHUNK_SIZE
+from common.timing import PhaseTimer
+from common.websites import WebsiteFile, diff_websites
+from common.sharding import Shard, index_shard
+from common.workers import WorkerPool
+from common.transport import get_transport
+from common.spool import Spool, InFlight
+from common.results import ResultQueue
 
-from pykafka.exceptions import SocketDisconnectedError, LeaderNotAvailable
+from pykafka.exceptions import KafkaException
 
 
 class WebsiteChecker(Thread):
-    def __init__(self, name, url, pattern, result_queue, log, interval=10):
+    def __init__(self, name, url, pattern, result_queue, log, interval=10,
+                 jitter=False, session_pool=None, cold=False, max_body=0,
+                 format='json', content_cache=False, timings=False):
         Thread.__init__(self)
         self.name = name
         self.url = url
@@ -28,50 +46,398 @@ class WebsiteChecker(Thread):
         self.result_queue = result_queue
         self.log = log
         self.interval = interval
+        self.jitter = jitter
+        self.session_pool = session_pool  # share keep-alive sessions
+        self.cold = cold  # check on a new connection every time
+        self.max_body = max_body  # maximum body bytes to scan, 0 no limit
+        self.format = format  # result record format, json or binary
+        self.url_time = 0  # last time url was included in binary result
+        self.compiled_pattern = compile_pattern(pattern)
+        # skip download or scan of unchanged body
+        self.cache = ContentCache() if content_cache else None
+        self.timings = timings  # add phase timings to results
+        self.wake = Event()  # interrupt waiting on stop or update
         self.stop_flag = False
+        self.lag = REGISTRY.gauge('checker_schedule_lag_seconds',
+                                  'delay between due time and check start')
+        self.lag_histogram = REGISTRY.histogram(
+            'checker_check_lag_seconds',
+            'distribution of delay between due time and check start')
+        self.duration = REGISTRY.histogram('checker_check_seconds',
+                                           'time taken by one check')
+        self.errors = REGISTRY.counter('checker_check_error_total',
+                                       'checks failed without result')
+        self.cache_hits = REGISTRY.counter('checker_content_cache_hit_total',
+                                           'checks reusing content status '
+                                           'of unchanged body')
 
     def run(self):
-        pattern = re.compile(self.pattern)
         self.log.info(f'start checking {self.name}, url={self.url}, '
                       f'interval={self.interval}')
+        next_due = time.monotonic()
+        if self.jitter:  # spread first check within one interval
+            next_due += random.uniform(0, self.interval)
         while True:
+            delay = next_due - time.monotonic()
+            if delay > 0:
+                self.wake.wait(delay)
+                self.wake.clear()
             if self.stop_flag:
                 break
+            now = time.monotonic()
+            if next_due > now + self.interval:  # interval was shortened
+                next_due = now + self.interval
+            if next_due > now:  # woken up by update
+                continue
+            self.lag.set(max(now - next_due, 0))
+            self.lag_histogram.observe(max(now - next_due, 0))
             try:
-                result = self.check_website(pattern)
+                result = self.check_website(self.compiled_pattern)
+                self.duration.observe(time.monotonic() - now)
                 self.result_queue.put(result)
             except Exception as e:
+                self.errors.inc()
                 self.log.error(e)
-            time.sleep(self.interval)
+            # next due time is based on previous due time to avoid drift
+            next_due += self.interval
+            now = time.monotonic()
+            if next_due < now:
+                next_due += ((now - next_due) // self.interval + 1) * \
+                    self.interval
 
     def stop(self):
         self.stop_flag = True
+        self.wake.set()
+
+    def update(self, url, pattern, interval=10, cold=False, max_body=0):
+        """ Change website in place, keeping its schedule """
+        if self.cache != None and (url, pattern, max_body) != \
+                (self.url, self.pattern, self.max_body):
+            self.cache = ContentCache()
+        if pattern != self.pattern:
+            self.compiled_pattern = compile_pattern(pattern)
+            self.pattern = pattern
+        if url != self.url:
+            self.url_time = 0  # send new url with next result
+        self.url = url
+        self.interval = interval
+        self.cold = cold
+        self.max_body = max_body
+        self.wake.set()
 
     def check_website(self, pattern):
+        if not self.timings:
+            return self._check_website(pattern)
+        with PhaseTimer() as timer:
+            return self._check_website(pattern, timer)
+
+    def _check_website(self, pattern, timer=None):
         start_time = time.time()
-        r = requests.get(self.url)
+        headers = dict()
+        if self.cache != None:
+            headers = self.cache.headers()  # conditional request
+        if self.cold:
+            r = cold_get(self.url, timed=timer != None, stream=True,
+                         headers=headers)
+        elif self.session_pool != None:
+            r = self.session_pool.get(self.url).get(self.url, stream=True,
+                                                    headers=headers)
+        else:
+            r = requests.get(self.url, stream=True, headers=headers)
+        if timer != None:
+            timer.mark('headers')
+        # stop downloading once pattern found or size limit reached
+        scanner = BodyScanner(pattern, max_size=self.max_body,
+                              cache=self.cache)
+        try:
+            if not scanner.response(r.status_code, r.headers):
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if scanner.feed(chunk):
+                        break
+                scanner.finish()
+        finally:
+            r.close()
         response_time = time.time() - start_time
-        content_check = bool(pattern.search(r.text))  # check pattern
-        time_tuple = time.localtime(start_time)
-        created_at = time.strftime("%Y-%m-%d %H:%M:%S", time_tuple)
-        result = {
-            'name': self.name,
-            'url': self.url,
-            'created_at': created_at,
-            'response_time': f'{response_time:.3f}',
-            'status_code': r.status_code,
-            'content_check': content_check,
-        }
+        timings = None
+        if timer != None:
+            timer.finish()
+            timings = timer.timings()
         self.log.debug(f'{r.status_code} - {self.url}')
-        return json.dumps(result).encode('utf-8')
+        if scanner.cache_hit:
+            self.cache_hits.inc()
+        with_url = start_time - self.url_time > URL_INTERVAL
+        if with_url:
+            self.url_time = start_time
+        return make_result(self.name, self.url, start_time, response_time,
+                           r.status_code, scanner.found,
+                           content_status=scanner.status,
+                           format=self.format,
+                           with_url=with_url,
+                           cache_hit=scanner.cache_hit,
+                           timings=timings)
+
+
+class CheckerGroup():
+    """ Start, stop and update website checks to match websites yaml.
+        Only added, removed and changed websites are touched, checks of
+        other websites keep running on their schedule.
+        Arguments:
+        - engine: AsyncCheckEngine in async mode, None for thread mode
+        - session_pool: sessions shared by checker threads
+        - jitter: spread first check of checker threads
+        - format: result record format of checker threads
+        - content_cache: checker threads send conditional requests and
+                         skip scanning unchanged body
+        - timings: checker threads add phase timings to results
+    """
+    def __init__(self, result_queue, log, engine=None, session_pool=None,
+                 jitter=False, format='json', content_cache=False,
+                 timings=False):
+        self.result_queue = result_queue
+        self.log = log
+        self.engine = engine
+        self.session_pool = session_pool
+        self.jitter = jitter
+        self.format = format
+        self.content_cache = content_cache
+        self.timings = timings
+        self.websites = dict()  # {name: config} of running websites
+        self.checkers = dict()  # {name: WebsiteChecker} in thread mode
+
+    def apply(self, websites):
+        """ Apply {name: config} from parse_websites(),
+            return (added, removed, changed) names
+        """
+        added, removed, changed = diff_websites(self.websites, websites)
+        for name in removed:
+            self.log.info(f'stop checking {name}')
+            if self.engine != None:
+                self.engine.remove_site(name)
+            else:
+                self.checkers.pop(name).stop()
+        for name in changed:
+            config = websites[name]
+            self.log.info(f'update {name}, {config}')
+            if self.engine != None:
+                self.engine.update_site(name, **config)
+            else:
+                self.checkers[name].update(**config)
+        for name in added:
+            config = websites[name]
+            if self.engine != None:
+                self.engine.add_site(name, **config)
+                continue
+            checker = WebsiteChecker(name,
+                                     config['url'],
+                                     config['pattern'],
+                                     self.result_queue,
+                                     self.log,
+                                     interval=config['interval'],
+                                     jitter=self.jitter,
+                                     session_pool=self.session_pool,
+                                     cold=config['cold'],
+                                     max_body=config['max_body'],
+                                     format=self.format,
+                                     content_cache=self.content_cache,
+                                     timings=self.timings)
+            checker.start()
+            self.checkers[name] = checker
+        self.websites = websites
+        return added, removed, changed
+
+    def stop(self):
+        for checker in self.checkers.values():
+            checker.stop()
+        if self.engine != None:
+            self.engine.stop()
+
+
+def report_assignment(website_file, websites, log):
+    """ Log websites assigned to this checker """
+    REGISTRY.gauge('checker_assigned_websites',
+                   'websites checked by this checker').set(len(websites))
+    if website_file.shard == None:
+        return
+    log.info(f'shard {website_file.shard}: checking {len(websites)} of '
+             f'{website_file.total} websites')
+    log.debug(f'assigned websites {sorted(websites)}')
+
+
+def reload_websites(website_file, group, log, worker=None):
+    try:
+        websites = website_file.read()
+    except Exception as e:
+        log.error(f'unable to reload websites, keep running websites. {e}')
+        return
+    if worker != None:
+        websites = worker.select(websites)
+    start_time = time.monotonic()
+    added, removed, changed = group.apply(websites)
+    log.info(f'reload websites, added={len(added)}, removed={len(removed)}, '
+             f'changed={len(changed)}, total={len(websites)}, '
+             f'took {time.monotonic() - start_time:.3f} seconds')
+    report_assignment(website_file, websites, log)
+
+
+def queue_depth(queue):
+    """ Return items in queue, 0 where platform can not tell """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return 0
+
+
+def forward_results(source, target):
+    """ Move results of worker queue to queue of main process """
+    while True:
+        target.put(source.get())
+
+
+def spool_results(result_queue, spool, log):
+    """ Move results from checks to spool """
+    while True:
+        result = result_queue.get()
+        try:
+            spool.append(result)
+        except Exception as e:
+            log.error(f'unable to spool result. {e}')
+
+
+def get_options(args, ck_cfg):
+    """ Return options of website checks from arguments and checker
+        config section
+    """
+    return {
+        'mode': args.mode,
+        'concurrency': int(args.concurrency),
+        'jitter': not args.nojitter,
+        'pool_connections': int(ck_cfg.get('pool_connections', 10)),
+        'pool_maxsize': int(ck_cfg.get('pool_maxsize', 10)),
+        'pool_idle_timeout': float(ck_cfg.get('pool_idle_timeout', 60)),
+        'format': ck_cfg.get('format', 'json'),
+        'content_cache': ck_cfg.get('content_cache', 'false') == 'true',
+        'dns_cache': ck_cfg.get('dns_cache', 'false') == 'true',
+        'dns_min_ttl': float(ck_cfg.get('dns_min_ttl', 30)),
+        'dns_max_ttl': float(ck_cfg.get('dns_max_ttl', 300)),
+        'dns_refresh': ck_cfg.get('dns_refresh', 'true') == 'true',
+        'tls_session_cache':
+            ck_cfg.get('tls_session_cache', 'false') == 'true',
+        'timings': ck_cfg.get('timings', 'false') == 'true',
+        'reload_interval': float(ck_cfg.get('reload_interval', 5)),
+        'metrics_port': int(ck_cfg.get('metrics_port', 0)),
+        # worker process N serves metrics on worker_metrics_port + N
+        'worker_metrics_port': int(ck_cfg.get(
+            'worker_metrics_port', int(ck_cfg.get('metrics_port', 0)) + 1)),
+        'metrics_host': ck_cfg.get('metrics_host', '127.0.0.1'),
+        'queue_size': int(ck_cfg.get('queue_size', 3000)),
+        'queue_policy': ck_cfg.get('queue_policy', 'block'),
+        'debug': args.debug,
+        'filelog': args.filelog,
+    }
+
+
+def start_checks(websites, result_queue, log, options):
+    """ Start checks of websites in thread or async mode,
+        return CheckerGroup
+    """
+    dns_cache = None
+    if options['dns_cache']:
+        dns_cache = DnsCache(log,
+                             min_ttl=options['dns_min_ttl'],
+                             max_ttl=options['dns_max_ttl'],
+                             refresh=options['dns_refresh'])
+    ssl_context = None
+    if options['tls_session_cache'] or options['timings']:
+        # context marks tls handshake start for phase timings
+        ssl_context = get_ssl_context(resume=options['tls_session_cache'])
+    if options['mode'] == 'async':
+        engine = AsyncCheckEngine(
+            result_queue,
+            log,
+            concurrency=options['concurrency'],
+            jitter=options['jitter'],
+            pool_maxsize=options['pool_maxsize'],
+            pool_idle_timeout=options['pool_idle_timeout'],
+            format=options['format'],
+            content_cache=options['content_cache'],
+            dns_cache=dns_cache,
+            ssl_context=ssl_context,
+            timings=options['timings'])
+        group = CheckerGroup(result_queue, log, engine=engine)
+        group.apply(websites)
+        engine.start()
+        return group
+    session_pool = SessionPool(pool_connections=options['pool_connections'],
+                               pool_maxsize=options['pool_maxsize'],
+                               idle_timeout=options['pool_idle_timeout'],
+                               dns_cache=dns_cache,
+                               ssl_context=ssl_context,
+                               timed=options['timings'])
+    group = CheckerGroup(result_queue,
+                         log,
+                         session_pool=session_pool,
+                         jitter=options['jitter'],
+                         format=options['format'],
+                         content_cache=options['content_cache'],
+                         timings=options['timings'])
+    group.apply(websites)
+    return group
+
+
+def run_worker(index, count, website_file, options, result_queue):
+    """ Worker process checking its slice of websites, results are sent
+        back to producer of main process through result_queue
+    """
+    level = logging.DEBUG if options['debug'] else logging.INFO
+    log = get_log(name=f'checker-{index}', level=level,
+                  filelog=options['filelog'])
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # stopped by main process
+    reload_event = Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
+    if options['metrics_port'] > 0:
+        # every worker process serves its own metrics on next ports
+        MetricsServer(options['worker_metrics_port'] + index, log,
+                      host=options['metrics_host']).start()
+    # slice of websites already selected by fleet shard
+    worker = index_shard(index, count, prefix='worker')
+    websites = worker.select(website_file.read())
+    report_assignment(website_file, websites, log)
+    if options['queue_policy'] != 'block':
+        # drop or coalesce results in worker, before they wait for main
+        # process
+        local_queue = ResultQueue(options['queue_size'],
+                                  policy=options['queue_policy'])
+        Thread(target=forward_results, args=(local_queue, result_queue),
+               daemon=True).start()
+        result_queue = local_queue
+    group = start_checks(websites, result_queue, log, options)
+    parent = os.getppid()
+    reload_interval = options['reload_interval']
+    reload_time = time.monotonic()
+    report_time = time.monotonic()
+    while os.getppid() == parent:  # exit when main process is gone
+        reload_event.wait(1)
+        if time.monotonic() - report_time > 60:  # report metrics
+            report_time = time.monotonic()
+            log.info(f'metrics {REGISTRY.snapshot()}')
+        if reload_interval > 0 and \
+                time.monotonic() - reload_time > reload_interval:
+            reload_time = time.monotonic()
+            if website_file.modified():
+                reload_event.set()
+        if reload_event.is_set():
+            reload_event.clear()
+            reload_websites(website_file, group, log, worker=worker)
+    group.stop()
 
 
 def main(args, log):
     log.info(f'Checker start.')
-    checkers = []  # store website checker threads
+    group = None  # website checks
+    workers = None  # worker processes in multi-process mode
+    spool = None  # results on disk waiting to be produced
     config_file = './config.ini'  # default config file name
     website_yaml_file = './websites.yaml'  # default websites yaml file name
-    result_queue = Queue(3000)  # queue to forward result to main thread
     kafka_tls = True  # enable tls connection to kafka
     try:
         check_interval = float(args.interval)
@@ -79,6 +445,8 @@ def main(args, log):
             log.warning(f'interval too small, set to 1.')
             check_interval = 1
         log.info(f'website check interval: {check_interval} seconds.')
+        check_mode = args.mode
+        log.info(f'website check mode: {check_mode}')
         if args.config != None:
             config_file = args.config
         log.info(f'configure file: {config_file}')
@@ -89,61 +457,203 @@ def main(args, log):
             kafka_tls = False
         log.info(f'kafka tls connection: {kafka_tls}')
 
-        # connect kafka and get topic
-        kf_cfg = get_config(config_file, 'kafka')  # read kafka config
-        for key in ('host', 'port', 'cafile', 'certfile', 'keyfile', 'topic'):
-            if key not in kf_cfg:
-                raise(f'kafka config missing {key}.')
-        kf = Kafka(kf_cfg['host'],
-                   kf_cfg['port'],
-                   kf_cfg['cafile'],
-                   kf_cfg['certfile'],
-                   kf_cfg['keyfile'],
-                   log)
-        if kf.set_client(tls=kafka_tls) == False:
-            raise Exception("error to set kafka client.")
-        topic = kf.get_topic(kf_cfg['topic'])  # get Kafka topic
-        if topic == False:
-            raise Exception("error to get kafka topic.")
-
-        # run website checker threads
-        websites = read_yaml(website_yaml_file)
-        for name, info in websites.items():
-            for key in ['url', 'pattern']:
-                if key not in info:
-                    raise(f'website config missing {key}')
-            checker = WebsiteChecker(name,
-                                     info['url'],
-                                     info['pattern'],
-                                     result_queue,
-                                     log,
-                                     interval=check_interval)
-            checker.start()
-            checkers.append(checker)
+        # connection pool config
+        ck_cfg = get_config(config_file, 'checker')
+        pool_maxsize = int(ck_cfg.get('pool_maxsize', 10))
+        pool_idle_timeout = float(ck_cfg.get('pool_idle_timeout', 60))
+        default_max_body = int(ck_cfg.get('max_body', 0))
+        result_format = ck_cfg.get('format', 'json')
+        log.info(f'result format: {result_format}')
+        log.info(f'connection pool maxsize={pool_maxsize}, '
+                 f'idle timeout={pool_idle_timeout}')
+
+        # connect result transport, kafka topic by default
+        transport = get_transport(config_file, log, tls=kafka_tls)
+        if transport.connect() == False:
+            raise Exception(f'error to connect {transport}.')
+
+        # check subset of websites when running in a fleet of checkers
+        shard = None
+        if args.shard_members != None:
+            members = [m.strip() for m in args.shard_members.split(',')]
+            shard = Shard(args.shard_name, members)
+        elif args.shard_count != None:
+            shard = index_shard(int(args.shard_index or 0),
+                                int(args.shard_count))
+        log.info(f'website shard: {shard}')
+
+        # run website checker threads or async check engine
+        website_file = WebsiteFile(website_yaml_file,
+                                   interval=check_interval,
+                                   max_body=default_max_body,
+                                   shard=shard)
+        websites = website_file.read()
+        report_assignment(website_file, websites, log)
+        options = get_options(args, ck_cfg)
+        # queue to forward result to main thread, policy applies when
+        # producer falls behind
+        result_queue = ResultQueue(options['queue_size'],
+                                   policy=options['queue_policy'])
+        log.info(f'result queue size={options["queue_size"]}, '
+                 f'policy={options["queue_policy"]}')
+        if options['metrics_port'] > 0:
+            MetricsServer(options['metrics_port'], log,
+                          host=options['metrics_host']).start()
+        processes = int(args.processes)
+        if processes > 1:
+            # worker processes check slices of websites and reload website
+            # yaml themselves, main process only produces results
+            workers = WorkerPool(run_worker, processes, log)
+            result_queue = workers.queue(options['queue_size'])
+            workers.start(website_file, options, result_queue)
+            log.info(f'started {processes} worker processes')
+        else:
+            group = start_checks(websites, result_queue, log, options)
+        REGISTRY.gauge('checker_result_queue_depth',
+                       'results waiting to be produced').set_function(
+            lambda: queue_depth(result_queue))
+        if ck_cfg.get('spool'):
+            # checks never wait for producer, results wait on disk
+            spool = Spool(
+                ck_cfg['spool'],
+                log,
+                segment_size=int(ck_cfg.get('spool_segment_size',
+                                            16 * 1024 * 1024)),
+                max_size=int(ck_cfg.get('spool_max_size',
+                                        1024 * 1024 * 1024)))
+            Thread(target=spool_results, args=(result_queue, spool, log),
+                   daemon=True).start()
+            log.info(f'spool results in {ck_cfg["spool"]}')
+            if options['queue_policy'] != 'block':
+                log.warning(f'queue_policy {options["queue_policy"]} has '
+                            f'no effect with spool, result queue is '
+                            f'drained to spool.')
+
+        # reload websites yaml on SIGHUP or when it is modified
+        reload_event = Event()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame:
+                          reload_event.set())
+        reload_interval = options['reload_interval']
+        log.info(f'website reload interval: {reload_interval}')
     except Exception as e:
         log.error(f'Exiting checker. {e}')
-        for checker in checkers:
-            checker.stop()
+        if group != None:
+            group.stop()
+        if workers != None:
+            workers.stop()
+        if spool != None:
+            spool.close()
         exit(1)
 
-    # produce check result to kafka
-    log.info(f'producing result to kafka.')
+    # produce check result through transport
+    log.info(f'producing result to {transport}.')
+    producer_sync = transport.sync
+    delivered = REGISTRY.counter('checker_produce_delivered_total',
+                                 'results acknowledged by kafka')
+    failed = REGISTRY.counter('checker_produce_failed_total',
+                              'results failed to deliver to kafka')
+    produced = REGISTRY.counter('checker_produced_total',
+                                'results passed to kafka producer')
+    produce_time = REGISTRY.histogram('checker_produce_seconds',
+                                      'time taken to produce one result')
+    retry = spool.append if spool != None else None  # failed deliveries
+    in_flight = None  # spooled results waiting for delivery report
+    if spool != None and not producer_sync:
+        in_flight = InFlight(spool)
+    retry_delay = 1
+    report_time = time.monotonic()
+    reload_time = time.monotonic()
+    supervise_time = time.monotonic()
     try:
-        with topic.get_sync_producer() as producer:
-            log.info(f'created sync producer.')
-            while True:
-                result = result_queue.get()  # get result from queue
-                log.debug(f'produce - {result}')
-                producer.produce(bytes(result))
-    except (SocketDisconnectedError, LeaderNotAvailable) as e:
+        while True:
+            producer = transport.get_producer()
+            if producer == False:
+                raise Exception("error to get producer.")
+            try:
+                with producer:
+                    log.info(f'created producer, sync={producer_sync}.')
+                    while True:
+                        if workers != None:
+                            # workers reload websites themselves, a SIGHUP
+                            # after this check is forwarded on next loop
+                            if reload_event.is_set():
+                                reload_event.clear()
+                                workers.signal(signal.SIGHUP)
+                            if time.monotonic() - supervise_time > 1:
+                                supervise_time = time.monotonic()
+                                workers.check()  # restart crashed workers
+                        else:
+                            if reload_interval > 0 and time.monotonic() - \
+                                    reload_time > reload_interval:
+                                reload_time = time.monotonic()
+                                if website_file.modified():
+                                    reload_event.set()
+                            if reload_event.is_set():
+                                reload_event.clear()
+                                reload_websites(website_file, group, log)
+                        if not producer_sync:
+                            # also while idle, to ack last spooled results
+                            count_delivery_reports(
+                                producer, delivered, failed, log,
+                                retry=retry,
+                                done=in_flight.report if in_flight != None
+                                else None)
+                        if spool != None:
+                            record = spool.get(timeout=1)
+                            if record == None:
+                                continue
+                            position, result = record
+                        else:
+                            try:
+                                result = result_queue.get(timeout=1)
+                            except Empty:
+                                continue
+                        log.debug(f'produce - {result}')
+                        start = time.monotonic()
+                        # keep results of one website in order on one
+                        # partition
+                        producer.produce(bytes(result),
+                                         partition_key=result_key(result))
+                        produce_time.observe(time.monotonic() - start)
+                        produced.inc()
+                        if in_flight != None:
+                            # acked once delivery is reported
+                            in_flight.add(position, result)
+                        elif spool != None:
+                            spool.ack(position)
+                        retry_delay = 1
+                        if time.monotonic() - report_time > 60:
+                            report_time = time.monotonic()  # report metrics
+                            log.info(f'metrics {REGISTRY.snapshot()}')
+            except KafkaException as e:
+                if spool == None:
+                    raise
+                # checks keep spooling while kafka is down, results not
+                # acked are produced again after reconnect
+                log.warning(f'producer failed, reconnect in {retry_delay} '
+                            f'seconds. {e}')
+                if in_flight != None:
+                    in_flight.clear()
+                spool.rewind()
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+                while transport.connect() == False:
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, 60)
+    except KafkaException as e:
         log.error(f'{e}')
     except KeyboardInterrupt:
         log.info(f'Stop running checker.')
     except Exception as e:
         log.error(f'Unknown exception occur. {e}')
     finally:
-        for checker in checkers:
-            checker.stop()
+        if group != None:
+            group.stop()
+        if workers != None:
+            workers.stop()
+        if spool != None:
+            spool.close()
 
 
 if __name__ == "__main__":
@@ -156,6 +666,20 @@ if __name__ == "__main__":
     parser.add_argument('--notls', action='store_true', help='disable tls')
     parser.add_argument('--filelog', action='store_true', help='log to file')
     parser.add_argument('--interval', default=10, help='checking interval')
+    parser.add_argument('--mode', default='thread',
+                        choices=['thread', 'async'],
+                        help='check mode, thread per website or async')
+    parser.add_argument('--concurrency', default=100,
+                        help='maximum concurrent checks in async mode')
+    parser.add_argument('--nojitter', action='store_true',
+                        help='start all website checks at once')
+    parser.add_argument('--processes', default=1,
+                        help='number of worker processes checking websites')
+    parser.add_argument('--shard-index', help='index of this checker')
+    parser.add_argument('--shard-count', help='number of checkers')
+    parser.add_argument('--shard-name', help='member name of this checker')
+    parser.add_argument('--shard-members',
+                        help='comma separated member names of checkers')
     args = parser.parse_args()
     if args.debug:
         if args.filelog:
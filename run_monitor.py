@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import daemon
+import os
+import signal
+
+from argparse import ArgumentParser
+from threading import Event
+
+from common.utils import *
+from common.pipeline import WriterPipeline
+from common.metrics import REGISTRY, MetricsServer
+from common.transport import LocalTransport
+from common.websites import WebsiteFile
+
+from run_checker import get_options, start_checks, reload_websites
+from run_checker import report_assignment
+from run_writer import get_database, get_websites, get_offsets
+from run_writer import get_pipeline_options
+
+
+def main(args, log):
+    log.info(f'Monitor start.')
+    group = None  # website checks
+    pipeline = None  # writer pipeline
+    db = None
+    config_file = './config.ini'  # default config file name
+    website_yaml_file = './websites.yaml'  # default websites yaml file name
+    try:
+        check_interval = float(args.interval)
+        if check_interval < 1:
+            log.warning(f'interval too small, set to 1.')
+            check_interval = 1
+        log.info(f'website check interval: {check_interval} seconds.')
+        log.info(f'website check mode: {args.mode}')
+        if args.config != None:
+            config_file = args.config
+        log.info(f'configure file: {config_file}')
+        if args.website != None:
+            website_yaml_file = args.website
+        log.info(f'website yaml file: {website_yaml_file}')
+
+        db_cfg = get_config(config_file, 'postgre')
+        for key in ('host', 'port', 'dbname', 'user', 'password'):
+            if key not in db_cfg:
+                raise Exception(f'database config missing {key}.')
+        db = get_database(db_cfg, log)
+        db.initialise_database()  # create tables if not exist
+        db.maintain_partitions()
+        log.info(f'database ingest method: {db.ingest}, '
+                 f'partition: {db.partition}')
+
+        # checks put results into queue consumed by writer pipeline, the
+        # queue is numbered as partition 0 of a local topic, so offsets are
+        # stored with results as with kafka
+        wr_cfg = get_config(config_file, 'writer')
+        pipeline_options = get_pipeline_options(wr_cfg)
+        tr_cfg = get_config(config_file, 'transport')
+        transport = LocalTransport(
+            log,
+            name=tr_cfg.get('name', 'local'),
+            queue_size=pipeline_options['queue_size'])
+        missing_urls = set()  # names of websites stored without url
+        website_ids = get_websites(db, log, missing_urls)
+        pipeline = WriterPipeline(
+            lambda offsets: transport.get_consumer(0, offsets.get(0, -1)),
+            db,
+            transport.name,
+            get_offsets(db, transport.name, log),
+            website_ids,
+            log,
+            missing_urls=missing_urls,
+            **pipeline_options)
+        log.info(f'writer {pipeline_options}')
+
+        ck_cfg = get_config(config_file, 'checker')
+        options = get_options(args, ck_cfg)
+        if options['metrics_port'] > 0:
+            MetricsServer(options['metrics_port'], log,
+                          host=options['metrics_host']).start()
+        REGISTRY.gauge('writer_message_queue_depth',
+                       'messages waiting to be decoded').set_function(
+            lambda: pipeline.message_queue.qsize())
+        REGISTRY.gauge('writer_row_queue_depth',
+                       'results waiting to be written').set_function(
+            lambda: pipeline.row_queue.qsize())
+        REGISTRY.gauge('checker_result_queue_depth',
+                       'results waiting to be consumed').set_function(
+            lambda: transport.queue.qsize())
+
+        website_file = WebsiteFile(website_yaml_file,
+                                   interval=check_interval,
+                                   max_body=int(ck_cfg.get('max_body', 0)))
+        websites = website_file.read()
+        report_assignment(website_file, websites, log)
+        pipeline.start()
+        group = start_checks(websites, transport.queue, log, options)
+
+        # reload websites yaml on SIGHUP or when it is modified
+        reload_event = Event()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame:
+                          reload_event.set())
+        reload_interval = options['reload_interval']
+        log.info(f'website reload interval: {reload_interval}')
+        reload_time = time.monotonic()
+        report_time = time.monotonic()
+        maintain_time = time.monotonic()
+        while True:
+            reload_event.wait(1)
+            if not pipeline.alive():
+                raise Exception(f'writer pipeline stage stopped.')
+            if reload_interval > 0 and \
+                    time.monotonic() - reload_time > reload_interval:
+                reload_time = time.monotonic()
+                if website_file.modified():
+                    reload_event.set()
+            if reload_event.is_set():
+                reload_event.clear()
+                reload_websites(website_file, group, log)
+            if time.monotonic() - report_time > 60:  # report metrics
+                report_time = time.monotonic()
+                log.info(f'metrics {REGISTRY.snapshot()}')
+            if time.monotonic() - maintain_time > 3600:
+                # create upcoming partitions and drop expired partitions
+                maintain_time = time.monotonic()
+                db.maintain_partitions()
+    except KeyboardInterrupt:
+        log.info(f'Stop running monitor.')
+    except Exception as e:
+        log.error(f'Exiting monitor. {e}')
+    finally:
+        if group != None:
+            group.stop()
+        if pipeline != None:
+            pipeline.stop()
+        if db != None:
+            db.disconnect()
+
+
+if __name__ == "__main__":
+    name = 'monitor'
+    parser = ArgumentParser(description=f'Website monitor - {name}')
+    parser.add_argument('--daemon', action='store_true', help='daemon mode')
+    parser.add_argument('--config', help='config file path')
+    parser.add_argument('--website', help='webiste list file')
+    parser.add_argument('--debug', action='store_true', help='enable debug')
+    parser.add_argument('--filelog', action='store_true', help='log to file')
+    parser.add_argument('--interval', default=10, help='checking interval')
+    parser.add_argument('--mode', default='thread',
+                        choices=['thread', 'async'],
+                        help='check mode, thread per website or async')
+    parser.add_argument('--concurrency', default=100,
+                        help='maximum concurrent checks in async mode')
+    parser.add_argument('--nojitter', action='store_true',
+                        help='start all website checks at once')
+    args = parser.parse_args()
+    if args.debug:
+        if args.filelog:
+            log = get_log(name=name, level=logging.DEBUG, filelog=True)
+        else:
+            log = get_log(name=name, level=logging.DEBUG)
+    else:
+        if args.filelog:
+            log = get_log(name=name, filelog=True)
+        else:
+            log = get_log(name=name)
+    if args.daemon:  # run in deamon mode
+        with daemon.DaemonContext(working_directory=os.getcwd()):
+            main(args, log)
+    else:
+        main(args, log)
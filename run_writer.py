@@ -10,19 +10,95 @@ from datetime import datetime
 from argparse import ArgumentParser
 
 from common.utils import *
-from common.kafka import Kafka
+from common.kafka import resume_offset
 from common.database import PostgreSQL
+from common.pipeline import WriterPipeline
+from common.metrics import REGISTRY, MetricsServer
+from common.transport import get_transport
 
 from pykafka.exceptions import SocketDisconnectedError, LeaderNotAvailable
 
 
+def get_database(db_cfg, log, min_pool_size=0):
+    """ Return connected PostgreSQL, pool holds at least min_pool_size
+        connections for threads sharing it
+    """
+    pool_size = max(int(db_cfg.get('pool_size', 4)), min_pool_size)
+    db = PostgreSQL(db_cfg['host'],
+                    db_cfg['port'],
+                    db_cfg['dbname'],
+                    db_cfg['user'],
+                    db_cfg['password'],
+                    log=log,
+                    ingest=db_cfg.get('ingest', 'values'),
+                    partition=db_cfg.get('partition'),
+                    partition_ahead=int(db_cfg.get('partition_ahead', 3)),
+                    retention_days=int(db_cfg.get('retention_days', 0)),
+                    rollup=db_cfg.get('rollup', 'false') == 'true',
+                    pool_size=pool_size,
+                    retries=int(db_cfg.get('retries', 3)),
+                    retry_delay=float(db_cfg.get('retry_delay', 0.5)),
+                    timings=db_cfg.get('timings', 'false') == 'true')
+    if db.connect() != True:  # set connection
+        log.error("unable to connect database.")
+        raise Exception("error to connect database.")
+    return db
+
+
+def get_websites(db, log, missing_urls=None):
+    """ Return {name: id} of websites in database
+        Arguments:
+        - missing_urls: set collecting names of websites stored without url
+    """
+    websites = dict()
+    rows = db.get_website()
+    for row in rows:
+        name = row[0]
+        website_id = row[2]
+        websites[name] = website_id
+        if missing_urls != None and not row[1]:
+            missing_urls.add(name)
+    log.info(f'websites in database: {len(websites)}')
+    return websites
+
+
+def get_offsets(db, topic_name, log):
+    """ Return {partition id: offset} stored in database for topic,
+        add topic when missing
+    """
+    row = db.get_topic_offset(topic_name)
+    if row == False:
+        log.info(f'add topic to database. topic={topic_name}')
+        now = datetime.now()
+        created_time = now.strftime("%Y-%m-%d %H:%M:%S")
+        db.add_topic(topic_name, created_time)
+    partition_offsets = db.get_partition_offsets(topic_name)
+    if partition_offsets == False:
+        raise Exception("error to get partition offsets.")
+    if partition_offsets == {} and row != False:
+        # offset stored by previous version for single partition topic
+        partition_offsets = {0: int(row[0])}
+    log.info(f'partition offsets in database are {partition_offsets}.')
+    return partition_offsets
+
+
+def get_pipeline_options(wr_cfg):
+    return {
+        'max_rows': int(wr_cfg.get('max_rows', 1000)),
+        'max_latency': float(wr_cfg.get('max_latency', 1)),
+        'queue_size': int(wr_cfg.get('queue_size', 10000)),
+    }
+
+
 def main(argv, log):
     log.info(f'Writer start.')
-    websites = dict()
+    websites = dict()  # {name: id}
+    missing_urls = set()  # names of websites stored without url
     config_file = './config.ini'  # default config file name
     kafka_tls = True  # enable tls connection to kafka
     db = None
-    kf = None
+    transport = None
+    pipelines = []  # writer pipeline of each partition
     try:
         if args.config != None:
             config_file = args.config
@@ -35,116 +111,146 @@ def main(argv, log):
         for key in ('host', 'port', 'dbname', 'user', 'password'):
             if key not in db_cfg:
                 raise(f'database config missing {key}.')
-        db = PostgreSQL(db_cfg['host'],
-                        db_cfg['port'],
-                        db_cfg['dbname'],
-                        db_cfg['user'],
-                        db_cfg['password'],
-                        log=log)
-        if db.connect() != True:  # set connection
-            log.error("unable to connect database.")
-            raise Exception("error to set kafka client.")
+
+        # connect result transport, kafka topic by default
+        transport = get_transport(config_file, log, tls=kafka_tls)
+        if transport.connect() == False:
+            raise Exception(f'error to connect {transport}.')
+        topic_name = transport.name
+        wr_cfg = get_config(config_file, 'writer')
+        consumer_mode = wr_cfg.get('consumer', 'simple')
+
+        # pipelines share one database object, every flush thread, main
+        # thread and rebalance callback use their own connection of pool
+        threads = 1
+        if consumer_mode != 'balanced':
+            threads = len(transport.partition_ids())
+        db = get_database(db_cfg, log, min_pool_size=threads + 2)
         db.initialise_database()  # create tables if not exist
+        db.maintain_partitions()
+        log.info(f'database ingest method: {db.ingest}, '
+                 f'partition: {db.partition}, pool size: {db.pool_size}')
 
-        # get all websites from database
-        rows = db.get_website()
-        for row in rows:
-            name = row[0]
-            url = row[1]
-            websites[name] = url
-        log.info(f'websites in database: {websites}')
-
-        # read kafka config
-        kf_cfg = get_config(config_file, 'kafka')
-        for key in ('host', 'port', 'cafile', 'certfile', 'keyfile', 'topic'):
-            if key not in kf_cfg:
-                raise(f'kafka config missing {key}.')
-        kf = Kafka(kf_cfg['host'],
-                   kf_cfg['port'],
-                   kf_cfg['cafile'],
-                   kf_cfg['certfile'],
-                   kf_cfg['keyfile'],
-                   log)
-        if kf.set_client(tls=kafka_tls) == False:  # set kafka client
-            raise Exception("error to set kafka client.")
-        topic_name = kf_cfg['topic']
-        topic = kf.get_topic(topic_name)
-        if topic == False:
-            raise Exception("error to get kafka topic.")
-
-        # get topic offset from database.
-        row = db.get_topic_offset(topic_name)
-        if row == False:
-            log.info(f'add topic to database. topic={topic_name}')
-            now = datetime.now()
-            created_time = now.strftime("%Y-%m-%d %H:%M:%S")
-            db.add_topic(topic_name, created_time)
-            db_offset = 0
-        else:
-            log.info(f'topic offset in database is {row}.')
-            db_offset = int(row[0])
+        # warm website id cache from database
+        websites.update(get_websites(db, log, missing_urls))
+
+        # get partition offsets from database.
+        partition_offsets = get_offsets(db, topic_name, log)
 
-        # ger kafka topic consumer
+        # consume, decode and write results in pipeline stages
         consumer_group_name = 'writer'
-        log.info(f'get simple consumer, group={consumer_group_name}')
-        consumer = topic.get_simple_consumer(
-            consumer_group=consumer_group_name,
-            consumer_timeout_ms=2000)
+        pipeline_options = get_pipeline_options(wr_cfg)
+        log.info(f'consumer mode={consumer_mode}, '
+                 f'group={consumer_group_name}, {pipeline_options}')
+        # latest offsets to log how long consuming backlog takes
+        latest_offsets = transport.latest_offsets()
+        if consumer_mode == 'balanced':
+            if not transport.balanced:
+                raise Exception(f'balanced consumer needs kafka transport.')
+            # share partitions with other writer processes in consumer group
+
+            def seek_offsets(consumer, old_offsets, new_offsets):
+                # seek newly assigned partitions to offset stored by the
+                # writer which owned them before, callback runs on a new
+                # consumer thread, so its connection goes back to pool
+                try:
+                    offsets = db.get_partition_offsets(topic_name)
+                finally:
+                    db.release()
+                if offsets == False:
+                    offsets = dict()
+                seek = dict()
+                for partition_id in new_offsets:
+                    if partition_id not in old_offsets:
+                        stored = offsets.get(partition_id, -1)
+                        pipeline.db_offsets[partition_id] = stored
+                        pipeline.consumed_offsets[partition_id] = stored
+                    seek[partition_id] = resume_offset(
+                        pipeline.consumed_offsets.get(partition_id, -1))
+                log.info(f'rebalanced, seek partitions to {seek}')
+                return seek
+
+            def get_consumer(offsets):
+                return transport.get_balanced_consumer(consumer_group_name,
+                                                       seek_offsets)
+
+            pipeline = WriterPipeline(get_consumer, db, topic_name,
+                                      partition_offsets, websites, log,
+                                      missing_urls=missing_urls,
+                                      **pipeline_options)
+            pipelines.append(pipeline)
+        else:
+            # one pipeline per partition, writing with own connection of db
+            for partition_id in transport.partition_ids():
+                def get_consumer(offsets, partition_id=partition_id):
+                    return transport.get_consumer(
+                        partition_id, offsets.get(partition_id, -1),
+                        consumer_group_name)
+
+                offsets = {partition_id: partition_offsets.get(partition_id,
+                                                               -1)}
+                pipeline = WriterPipeline(
+                    get_consumer,
+                    db,
+                    topic_name,
+                    offsets,
+                    websites,
+                    log,
+                    missing_urls=missing_urls,
+                    catch_up_offsets={
+                        partition_id: latest_offsets[partition_id]
+                        for partition_id in offsets
+                        if partition_id in latest_offsets},
+                    **pipeline_options)
+                pipelines.append(pipeline)
+
+        metrics_port = int(wr_cfg.get('metrics_port', 0))
+        if metrics_port > 0:
+            MetricsServer(metrics_port, log,
+                          host=wr_cfg.get('metrics_host', '127.0.0.1')).start()
+        REGISTRY.gauge('writer_message_queue_depth',
+                       'messages waiting to be decoded').set_function(
+            lambda: sum(p.message_queue.qsize() for p in pipelines))
+        REGISTRY.gauge('writer_row_queue_depth',
+                       'results waiting to be written').set_function(
+            lambda: sum(p.row_queue.qsize() for p in pipelines))
+        consumer_lag = REGISTRY.gauge('writer_consumer_lag_messages',
+                                      'messages in transport not consumed '
+                                      'yet')
 
-        log.info(f'start consuming messages.')
+        log.info(f'start consuming messages, pipelines={len(pipelines)}')
+        for pipeline in pipelines:
+            pipeline.start()
+        maintain_time = time.monotonic()
+        lag_time = 0
         while True:
-            results = []  # bulk results to store into database
-            for i in range(0, 100):
+            time.sleep(1)
+            if not all(pipeline.alive() for pipeline in pipelines):
+                # restart resumes after offsets stored in database
+                raise Exception(f'writer pipeline stage stopped.')
+            if time.monotonic() - lag_time > 10:
+                # latest offsets are asked from kafka, not every second
+                lag_time = time.monotonic()
                 try:
-                    message = consumer.consume()
-                    if message == None:
-                        break
-                except (SocketDisconnectedError) as e:
-                    # handling connection loss
-                    log.warning(f'consumer socket disconnect. {e}')
-                    time.sleep(1)
-                    consumer = topic.get_simple_consumer(
-                        consumer_group=consumer_group_name,
-                        consumer_timeout_ms=2000)
-                    break
+                    latest_offsets = transport.latest_offsets()
+                    consumer_lag.set(sum(pipeline.lag(latest_offsets)
+                                         for pipeline in pipelines))
                 except Exception as e:
-                    log.warning(f'consumer exception occur. {e}')
-                    break
-                # processing message
-                log.debug(f'consuming message, offset={message.offset}')
-                result = json.loads(message.value.decode('utf-8'))
-                name = result['name']
-                url = result['url']
-
-                # append new offset result to bulk result when offset value
-                # in database is less than offset value in kafka topic
-                if db_offset < message.offset:
-                    if name not in websites:  # add new website to database
-                        now = datetime.now()
-                        created_time = now.strftime("%Y-%m-%d %H:%M:%S")
-                        log.info(f'add new website {name}, {url}')
-                        db.add_website(created_time, name, url)
-                        websites[name] = url
-                    created_at = result['created_at']
-                    status_code = result['status_code']
-                    response_time = result['response_time']
-                    content_check = result['content_check']
-                    values = (created_at, name, status_code,
-                              response_time, content_check)
-                    results.append(values)
-
-            # write results to database
-            if results != []:
-                result_count = len(results)
-                log.debug(f'write {result_count} new results to database.')
-                db_offset += result_count
-                db.add_check_results(results, topic_name, db_offset)
+                    log.warning(f'unable to get latest offsets. {e}')
+            if time.monotonic() - maintain_time > 3600:
+                # create upcoming partitions and drop expired partitions
+                maintain_time = time.monotonic()
+                db.maintain_partitions()
 
     except Exception as e:
         log.error(e)
     except KeyboardInterrupt:
         log.info("stop running writer.")
     finally:
+        for pipeline in pipelines:
+            pipeline.stop()
+        if transport != None:
+            transport.close()
         if db != None:
             db.disconnect()
 
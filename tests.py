@@ -3,6 +3,7 @@
 
 import logging
 import sys
+import time
 
 from common.database import PostgreSQL
 from common.kafka import Kafka
@@ -58,8 +59,684 @@ def test_website_checker():
     assert 'status_code' in result
     assert 'content_check' in result
 
+def test_scheduler():
+    from common.scheduler import Scheduler
+
+    scheduler = Scheduler(jitter=False)
+    scheduler.add('a', 10, now=0)
+    scheduler.add('b', 5, now=0)
+    assert scheduler.pop_due(0) == [('a', 0), ('b', 0)]
+    assert scheduler.next_due() == 5
+    # next due time does not depend on when the check was dispatched
+    assert scheduler.pop_due(11) == [('b', 5), ('a', 10)]
+    assert scheduler.next_due() == 15
+    scheduler.remove('b')
+    assert scheduler.pop_due(20) == [('a', 20)]
+    # shorter interval moves next check forward
+    scheduler.update('a', 2, now=21)
+    assert scheduler.next_due() == 23
+
+
+def test_diff_websites():
+    from common.websites import parse_websites, diff_websites
+
+    running = parse_websites({
+        'a': {'url': 'https://a', 'pattern': 'a'},
+        'b': {'url': 'https://b', 'pattern': 'b'},
+        'c': {'url': 'https://c', 'pattern': 'c', 'interval': 30},
+    }, interval=10)
+    assert running['a']['interval'] == 10
+    websites = parse_websites({
+        'a': {'url': 'https://a', 'pattern': 'a'},
+        'c': {'url': 'https://c', 'pattern': 'c', 'interval': 60},
+        'd': {'url': 'https://d', 'pattern': 'd'},
+    }, interval=10)
+    assert diff_websites(running, websites) == (['d'], ['b'], ['c'])
+    # name must fit in binary record
+    try:
+        parse_websites({'é' * 128: {'url': 'https://e', 'pattern': 'e'}})
+        assert False
+    except Exception as e:
+        assert 'longer than 255 bytes' in str(e)
+
+
+def test_sharding():
+    from common.sharding import HashRing, index_shard
+
+    names = [f'site{i}' for i in range(1000)]
+    shards = [index_shard(i, 4) for i in range(4)]
+    owned = [set(filter(shard.owns, names)) for shard in shards]
+    assert sum(len(o) for o in owned) == len(names)
+    assert set.union(*owned) == set(names)
+    # adding fifth shard moves only sites to the new shard, about 1/5
+    ring = HashRing([f'shard-{i}' for i in range(4)])
+    new_ring = HashRing([f'shard-{i}' for i in range(5)])
+    moved = [name for name in names if ring.owner(name) !=
+             new_ring.owner(name)]
+    assert all(new_ring.owner(name) == 'shard-4' for name in moved)
+    assert 100 < len(moved) < 300
+    # worker processes split the sites of one shard evenly
+    workers = [index_shard(i, 4, prefix='worker') for i in range(4)]
+    for worker in workers:
+        assert 30 < len(set(filter(worker.owns, owned[0]))) < 100
+
+
+def test_body_scanner():
+    from common.content import BodyScanner, compile_pattern
+    from common.content import FOUND, NOT_FOUND, TRUNCATED
+
+    pattern = compile_pattern('success')
+    scanner = BodyScanner(pattern)
+    assert scanner.feed(b'x' * 100 + b'suc') == False
+    assert scanner.feed(b'cess') == True  # match across chunk boundary
+    assert scanner.status == FOUND
+
+    scanner = BodyScanner(pattern, max_size=10)
+    assert scanner.feed(b'x' * 8) == False
+    assert scanner.feed(b'xxsuccess') == True
+    assert scanner.status == TRUNCATED
+
+    scanner = BodyScanner(pattern)
+    scanner.feed(b'failure')
+    assert scanner.status == NOT_FOUND
+
+    # body decoded with charset of response, character split by chunks
+    scanner = BodyScanner(compile_pattern('(?i)ÉTÉ'))
+    scanner.response(200, {'Content-Type': 'text/html; charset=utf-8'})
+    assert scanner.feed('été'.encode('utf-8')[:3]) == False
+    assert scanner.feed('été'.encode('utf-8')[3:]) == True
+    scanner = BodyScanner(compile_pattern(r'caf\w'))
+    scanner.response(200, {'Content-Type': 'text/html; charset=latin-1'})
+    assert scanner.feed('café'.encode('latin-1')) == True
+    # match longer than default overlap across chunk boundary
+    scanner = BodyScanner(compile_pattern('<a>.*</a>'))
+    assert scanner.feed(b'<a>' + b'x' * 4000) == False
+    assert scanner.feed(b'x' * 4000 + b'</a>') == True
+
+
+def test_content_cache():
+    from common.content import BodyScanner, ContentCache, compile_pattern
+    from common.content import FOUND, NOT_FOUND, CACHE_MAX_SIZE
+
+    pattern = compile_pattern('success')
+    cache = ContentCache()
+
+    def scan(chunks):
+        scanner = BodyScanner(pattern, cache=cache)
+        for chunk in chunks:
+            if scanner.feed(chunk):
+                break
+        scanner.finish()
+        return scanner.status, scanner.cache_hit
+
+    assert scan([b'abc success', b'xyz']) == (FOUND, False)
+    # same body in different chunks reuses previous status
+    assert scan([b'abc', b' success', b'xyz']) == (FOUND, True)
+    assert scan([b'abc failure']) == (NOT_FOUND, False)
+    assert scan([b'abc failure']) == (NOT_FOUND, True)
+    assert scan([b'abc failure', b' success']) == (FOUND, False)
+    # not modified response reuses status without body
+    cache.update_validators({'ETag': '"v1"'})
+    assert cache.headers() == {'If-None-Match': '"v1"'}
+    scanner = BodyScanner(pattern, cache=cache)
+    assert scanner.response(304, {}) == True
+    assert scanner.status == FOUND and scanner.cache_hit
+    # body too large to cache is requested and scanned again next time
+    scanner = BodyScanner(pattern, cache=cache)
+    scanner.response(200, {'ETag': '"v2"'})
+    scanner.feed(b'x' * (CACHE_MAX_SIZE + 1))
+    scanner.finish()
+    assert cache.headers() == {} and cache.etag == None
+
+
+def test_dns_cache():
+    import logging
+    from common.resolver import DnsCache, is_ip_address
+
+    assert is_ip_address('127.0.0.1') and is_ip_address('[::1]')
+    assert not is_ip_address('localhost')
+    cache = DnsCache(logging, min_ttl=30, max_ttl=60, refresh=False)
+    infos = cache.resolve('localhost', 80)
+    assert cache.resolve('localhost', 80) == infos
+    assert cache.hits.value >= 1 and cache.hit_ratio() > 0
+
+
+def test_phase_timer():
+    from common.timing import PhaseTimer, mark
+
+    with PhaseTimer() as timer:
+        for event in ('connect_start', 'dns_start', 'dns_end', 'tcp_end',
+                      'connected', 'headers'):
+            mark(event)
+    timings = timer.timings()
+    assert sorted(timings) == ['connect', 'dns', 'tls', 'transfer', 'ttfb']
+    assert all(value >= 0 for value in timings.values())
+    mark('headers')  # no check running
+    # reused connection has no connection phases
+    with PhaseTimer() as timer:
+        timer.mark('headers')
+    timings = timer.timings()
+    assert timings['dns'] == timings['connect'] == timings['tls'] == 0
+
+
+def test_metrics():
+    from common.metrics import Registry
+
+    registry = Registry()
+    registry.counter('test_total', 'test counter').inc(2)
+    registry.gauge('test_depth').set_function(lambda: 3)
+    histogram = registry.histogram('test_seconds', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert '# TYPE test_total counter' in lines
+    assert 'test_total 2' in lines
+    assert 'test_depth 3' in lines
+    assert 'test_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{le="1"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'test_seconds_count 4' in lines
+    assert registry.snapshot()['test_seconds_count'] == 4
+
+
+def test_record():
+    import json
+    from common.record import make_result, decode_result
+
+    binary = make_result('test', 'https://google.com', 1600000000, 0.5, 200,
+                         True, content_status='found', format='binary')
+    result = decode_result(binary)
+    assert result['name'] == 'test'
+    assert result['url'] == 'https://google.com'
+    assert result['response_time'] == 0.5
+    assert result['status_code'] == 200
+    assert result['content_check'] == True
+    assert result['content_status'] == 'found'
+
+    binary = make_result('test', 'https://google.com', 1600000000, 0.5, 200,
+                         False, format='binary', with_url=False)
+    assert decode_result(binary)['url'] == None
+
+    timings = {'dns': 0.001, 'connect': 0.002, 'tls': 0.003, 'ttfb': 0.1,
+               'transfer': 0.05}
+    binary = make_result('test', 'https://google.com', 1600000000, 0.5, 200,
+                         True, format='binary', timings=timings)
+    assert decode_result(binary)['timings'] == timings
+    data = make_result('test', 'https://google.com', 1600000000, 0.5, 200,
+                       True, timings=timings)
+    assert decode_result(data)['timings'] == timings
+    assert decode_result(make_result('test', 'https://google.com',
+                                     1600000000, 0.5, 200, True,
+                                     format='binary'))['timings'] == None
+    # json result with only some phases stores the others as NULL
+    from common.pipeline import timing_values
+    assert timing_values({'timings': {'dns': 0.001, 'ttfb': 0.1}}) == \
+        (0.001, None, None, 0.1, None)
+
+    # json result is still accepted
+    data = make_result('test', 'https://google.com', 1600000000, 0.5, 200,
+                       True)
+    assert json.loads(data.decode('utf-8'))['name'] == 'test'
+    assert decode_result(data)['response_time'] == 0.5
+
+
+def test_rollup():
+    from common.rollup import aggregate, percentile
+
+    results = [('2021-03-18 09:34:%02d' % i, 1, 200 if i else 500,
+                0.1, i % 2 == 0) for i in range(10)]
+    rows = aggregate(results, 60)
+    assert len(rows) == 1
+    website_id, bucket, count, success, content_fail, low, high, total, \
+        sketch = rows[0]
+    assert website_id == 1
+    assert str(bucket) == '2021-03-18 09:34:00'
+    assert (count, success, content_fail) == (10, 9, 5)
+    assert low == high == 0.1
+    assert 0.1 <= percentile(sketch, 95) < 0.15
+
+
+def test_pgcopy():
+    from datetime import datetime
+    from common.pgcopy import text_buffer, binary_buffer
+
+    # tab, newline, carriage return and backslash escaped, NULL as \N
+    data = text_buffer([(1, 'a\tb\nc\rd\\e', None, True, 0.5),
+                        (2, 'x', 'y', False, None)]).getvalue()
+    assert data == '1\ta\\tb\\nc\\rd\\\\e\t\\N\tt\t0.5\n' \
+                   '2\tx\ty\tf\t\\N\n'
+
+    # signature, flags and header extension length
+    header = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+    trailer = b'\xff\xff'
+    data = binary_buffer([(1, None, 'é', True)],
+                         ('int4', 'int8', 'text', 'bool')).getvalue()
+    assert data == header + b'\x00\x04' + \
+        b'\x00\x00\x00\x04' + b'\x00\x00\x00\x01' + \
+        b'\xff\xff\xff\xff' + \
+        b'\x00\x00\x00\x02' + b'\xc3\xa9' + \
+        b'\x00\x00\x00\x01' + b'\x01' + trailer
+    assert binary_buffer([], ('int4',)).getvalue() == header + trailer
+
+    # timestamp is microseconds since 2000-01-01, float4 is IEEE 754
+    data = binary_buffer([(datetime(2000, 1, 1, 0, 0, 1), 0.5),
+                          ('1999-12-31 23:59:59', -2.0)],
+                         ('timestamp', 'float4')).getvalue()
+    assert data == header + \
+        b'\x00\x02' + b'\x00\x00\x00\x08' + \
+        b'\x00\x00\x00\x00\x00\x0f\x42\x40' + \
+        b'\x00\x00\x00\x04' + b'\x3f\x00\x00\x00' + \
+        b'\x00\x02' + b'\x00\x00\x00\x08' + \
+        b'\xff\xff\xff\xff\xff\xf0\xbd\xc0' + \
+        b'\x00\x00\x00\x04' + b'\xc0\x00\x00\x00' + trailer
+
+
+def test_transport():
+    import os
+    import tempfile
+    from common.transport import LocalTransport, UnixSocketTransport
+
+    log = get_log(name='test')
+    transport = LocalTransport(log)
+    with transport.get_producer() as producer:
+        producer.produce(b'a')
+        producer.produce(b'b')
+    # offsets continue after offset stored in database
+    consumer = transport.get_consumer(0, 41)
+    message = consumer.consume()
+    assert (message.partition_id, message.offset, message.value) == \
+        (0, 42, b'a')
+    assert transport.latest_offsets() == {0: 44}
+    assert consumer.consume().offset == 43
+    assert consumer.consume(timeout=0.01) == None
+
+    path = os.path.join(tempfile.mkdtemp(), 'monitor.sock')
+    transport = UnixSocketTransport(path, log)
+    consumer = transport.get_consumer(0, -1)
+    with transport.get_producer() as producer:
+        producer.produce(b'x' * 70000)
+        producer.produce(b'y')
+    assert consumer.consume().value == b'x' * 70000
+    message = consumer.consume()
+    assert (message.offset, message.value) == (1, b'y')
+    transport.close()
+    assert not os.path.exists(path)
+
+
+def test_spool():
+    import tempfile
+    from common.spool import Spool, InFlight
+
+    log = get_log(name='test')
+    path = tempfile.mkdtemp()
+    spool = Spool(path, log, segment_size=1024, max_size=4096)
+    for i in range(30):
+        spool.append(b'%02d' % i + b'x' * 90)
+    assert spool.depth() == 30
+    for i in range(5):
+        position, value = spool.get(timeout=0)
+        spool.ack(position)
+    assert spool.get(timeout=0)[1][:2] == b'05'
+    spool.rewind()  # not acked, read again
+    assert spool.get(timeout=0)[1][:2] == b'05'
+    spool.close()
+
+    # results not acked are replayed after restart
+    spool = Spool(path, log, segment_size=1024, max_size=4096)
+    assert spool.depth() == 25
+    assert spool.get(timeout=0)[1][:2] == b'05'
+    # oldest segments are dropped beyond max_size
+    for i in range(60):
+        spool.append(b'%02d' % i + b'x' * 90)
+    assert spool.dropped.value > 0
+    assert spool.size() <= 4096
+    spool.close()
+
+    # async deliveries are acked once older results are delivered
+    spool = Spool(tempfile.mkdtemp(), log, segment_size=1024)
+    in_flight = InFlight(spool)
+    for value in (b'a', b'b', b'c'):
+        spool.append(value)
+        in_flight.add(*spool.get(timeout=0))
+    in_flight.report(b'b')
+    assert spool.depth() == 3
+    in_flight.report(b'a')
+    assert spool.depth() == 1 and len(in_flight) == 1
+    spool.close()
+
+
+def test_result_queue():
+    from common.record import make_result, decode_result
+    from common.results import ResultQueue
+
+    def result(name, start_time, status_code=200, with_url=False):
+        return make_result(name, f'https://{name}.com', start_time, 0.5,
+                           status_code, True, format='binary',
+                           with_url=with_url)
+
+    queue = ResultQueue(10, policy='coalesce')
+    queue.put(result('a', 1, with_url=True))
+    queue.put(result('a', 2))
+    queue.put(result('a', 3))  # replaces 2, same state
+    queue.put(result('b', 4))
+    queue.put(result('a', 5, 500))  # status change is kept
+    assert queue.qsize() == 4
+    assert queue.coalesced.value >= 1
+    delivered = []
+    while queue.qsize():
+        decoded = decode_result(queue.get())
+        delivered.append((decoded['name'], decoded['created_at'].second))
+    # latest website first, results of a website in order
+    assert delivered == [('a', 1), ('a', 3), ('a', 5), ('b', 4)]
+
+    # flapping website over max_per_site keeps first and latest states
+    queue = ResultQueue(10, policy='coalesce', max_per_site=3)
+    for i, status_code in enumerate((200, 500, 200, 500, 404)):
+        queue.put(result('a', i, status_code))
+    delivered = []
+    while queue.qsize():
+        decoded = decode_result(queue.get())
+        delivered.append((decoded['status_code'],
+                          decoded['created_at'].second))
+    assert delivered == [(200, 2), (500, 3), (404, 4)]
+
+    queue = ResultQueue(2, policy='drop_oldest')
+    for i in range(3):
+        queue.put(result(f'site{i}', i))
+    assert queue.qsize() == 2
+    assert decode_result(queue.get())['name'] == 'site2'
+    assert decode_result(queue.get())['name'] == 'site1'
+
+
+class StubDatabase():
+    """ Database of writer pipeline tests, failing the first fail batches
+        and rejecting rows with status code in reject
+    """
+    timings = False
+
+    def __init__(self, fail=0, reject=()):
+        self.batches = []  # [(rows, offsets), ]
+        self.fail = fail
+        self.reject = reject
+
+    def add_websites(self, websites, invalid=None):
+        ids = dict()
+        for name in websites:
+            if len(name) > 32:
+                invalid.append(name)
+            else:
+                ids[name] = len(ids) + 1
+        return ids
+
+    def add_check_results(self, rows, topic_name, offsets, invalid=None):
+        if self.fail > 0:
+            self.fail -= 1
+            return False
+        invalid.extend(row for row in rows if row[2] in self.reject)
+        self.batches.append(([row for row in rows if row not in invalid],
+                             dict(offsets)))
+        return True
+
+    def release(self):
+        pass
+
+
+class StubConsumer():
+    """ Consumer returning given messages, then nothing """
+    def __init__(self, values):
+        from common.transport import Message
+
+        self.messages = [Message(0, offset, value)
+                         for offset, value in enumerate(values)]
+
+    def consume(self):
+        if not self.messages:
+            time.sleep(0.01)
+            return None
+        return self.messages.pop(0)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_writer_pipeline():
+    from common.pipeline import WriterPipeline
+    from common.record import make_result, decode_result
+
+    log = get_log(name='test')
+
+    def result(name, status_code=200):
+        return make_result(name, f'https://{name}.com', 1600000000, 0.5,
+                           status_code, True)
+
+    def pipeline(db, values, **kwargs):
+        return WriterPipeline(lambda offsets: StubConsumer(values), db,
+                              'topic', {}, {}, log, **kwargs)
+
+    # batch is written when max_rows results are buffered
+    db = StubDatabase()
+    writer = pipeline(db, [result(f'site{i}') for i in range(5)],
+                      max_rows=2, max_latency=60)
+    writer.start()
+    assert wait_for(lambda: len(db.batches) == 2)
+    time.sleep(0.1)
+    assert [len(rows) for rows, offsets in db.batches] == [2, 2]
+    assert writer.db_offsets == {0: 3}
+    writer.stop()
+
+    # or when oldest buffered result is max_latency old
+    db = StubDatabase()
+    writer = pipeline(db, [result(f'site{i}') for i in range(3)],
+                      max_rows=100, max_latency=0.2)
+    writer.start()
+    assert wait_for(lambda: len(db.batches) == 1)
+    assert len(db.batches[0][0]) == 3 and writer.db_offsets == {0: 2}
+    writer.stop()
+
+    # malformed messages are skipped, no stage dies
+    db = StubDatabase()
+    writer = pipeline(db, [b'{"name": "x"}', b'\x01broken', result('a'),
+                           b'not json', result('b')], max_latency=0.1)
+    invalid = writer.invalid.value
+    writer.start()
+    assert wait_for(lambda: sum(len(rows) for rows, offsets in
+                                db.batches) == 2)
+    assert writer.alive() and writer.invalid.value - invalid == 3
+    assert wait_for(lambda: writer.db_offsets == {0: 4})
+    writer.stop()
+
+    # failed batch is retried, offsets advance once it is written
+    db = StubDatabase(fail=1)
+    writer = pipeline(db, [])
+    retries = writer.retries.value
+    writer.flush([decode_result(result('a'))], {0: 7})
+    assert writer.retries.value - retries == 1
+    assert len(db.batches) == 1 and writer.db_offsets == {0: 7}
+
+    # rejected websites and rows are skipped, offsets still advance
+    db = StubDatabase(reject=(999,))
+    writer = pipeline(db, [])
+    invalid = writer.invalid.value
+    writer.flush([decode_result(result('a')), decode_result(result('x' * 40)),
+                  decode_result(result('b', 999))], {0: 9})
+    assert writer.invalid.value - invalid == 2
+    assert [row[2] for row in db.batches[0][0]] == [200]
+    assert writer.db_offsets == {0: 9}
+
+
+class FakeCursor():
+    """ Cursor of FakeConnection, statements containing conn.fail raise
+        conn.error
+    """
+    def __init__(self, conn):
+        self.connection = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def mogrify(self, template, args):
+        return repr(args).encode('utf-8')
+
+    def execute(self, statement, vars=None):
+        from psycopg2 import OperationalError
+        from psycopg2.extensions import TRANSACTION_STATUS_INTRANS
+
+        conn = self.connection
+        if conn.closed:
+            raise conn.error('connection already closed')
+        if isinstance(statement, bytes):
+            statement = statement.decode('utf-8')
+        statement = ' '.join(statement.split())
+        if conn.fail != None and conn.fail in statement:
+            if issubclass(conn.error, OperationalError):
+                conn.closed = 2  # connection lost
+            raise conn.error(f'failed {statement}')
+        conn.log.append(statement)
+        conn.info.transaction_status = TRANSACTION_STATUS_INTRANS
+
+
+class FakeConnection():
+    """ psycopg2 connection recording executed statements """
+    encoding = 'UTF8'
+
+    def __init__(self, fail=None, error=None):
+        from types import SimpleNamespace
+
+        self.closed = 0
+        self.info = SimpleNamespace(transaction_status=0)  # idle
+        self.log = []
+        self.fail = fail  # statement text to fail
+        self.error = error
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append('COMMIT')
+        self.info.transaction_status = 0
+
+    def rollback(self):
+        if self.closed:
+            raise self.error('connection already closed')
+        self.log.append('ROLLBACK')
+        self.info.transaction_status = 0
+
+
+class FakePool():
+    """ Pool handing out given connections in turn """
+    def __init__(self, conns):
+        self.conns = list(conns)
+        self.returned = []
+        self.closed = False
+
+    def getconn(self):
+        return self.conns.pop(0)
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+def fake_database(conns, **kwargs):
+    db = PostgreSQL('localhost', 5432, 'test', 'test', '',
+                    get_log(name='test'), **kwargs)
+    db.pool = FakePool(conns)
+    return db
+
+
+def test_database_health_check():
+    # idle connection is checked before use
+    conn = FakeConnection()
+    db = fake_database([conn], health_check=0)
+    db.conn.cursor().execute('SELECT 2')
+    db.conn.commit()
+    time.sleep(0.01)
+    assert db.conn is conn
+    assert conn.log == ['SELECT 2', 'COMMIT', 'SELECT 1', 'ROLLBACK']
+    # a transaction open longer than health_check is not rolled back
+    conn.log = []
+    time.sleep(0.01)
+    db.conn.cursor().execute('INSERT 1')
+    time.sleep(0.01)
+    db.conn.cursor().execute('INSERT 2')
+    db.conn.commit()
+    assert conn.log == ['SELECT 1', 'ROLLBACK', 'INSERT 1', 'INSERT 2',
+                        'COMMIT']
+    conn.log = []
+    assert db.add_check_results([('2021-03-18 09:34:00', 1, 200, 0.1, True)],
+                                'topic', {0: 7}) == True
+    assert conn.log[2].startswith('INSERT INTO status_history')
+    assert conn.log[3].startswith('INSERT INTO topic_partition')
+    assert conn.log[4:] == ['COMMIT']
+
+
+def test_database_retry():
+    from psycopg2 import OperationalError, DataError
+
+    ok = ('2021-03-18 09:34:00', 1, 200, 0.1, True)
+    bad = ('2021-03-18 09:34:01', 1, 99999, 0.1, True)
+    # batch is retried on a new connection after connection error
+    broken = FakeConnection(fail='INSERT INTO status_history',
+                            error=OperationalError)
+    conn = FakeConnection()
+    db = fake_database([broken, conn], retry_delay=0)
+    assert db.add_check_results([ok], 'topic', {0: 7}) == True
+    assert db.pool.returned == [(broken, True)]
+    assert conn.log[-1] == 'COMMIT' and 'COMMIT' not in broken.log
+    # gives up after retries
+    db = fake_database([FakeConnection(fail='INSERT',
+                                       error=OperationalError)
+                        for i in range(3)], retries=2, retry_delay=0)
+    assert db.add_check_results([ok], 'topic', {0: 7}) == False
+    assert len(db.pool.returned) == 3
+
+    # closed connection is returned to pool and replaced on next use
+    first, second = FakeConnection(), FakeConnection()
+    db = fake_database([first, second])
+    assert db.conn is first
+    first.closed = 1
+    assert db.conn is second and db.pool.returned == [(first, True)]
+
+    # rejected rows are skipped in savepoints, rest is committed
+    conn = FakeConnection(fail='99999', error=DataError)
+    db = fake_database([conn])
+    assert db.add_check_results([ok, bad], 'topic', {0: 7}) == False
+    invalid = []
+    assert db.add_check_results([ok, bad], 'topic', {0: 7},
+                                invalid=invalid) == True
+    assert invalid == [bad]
+    assert 'ROLLBACK TO SAVEPOINT result' in conn.log
+    assert conn.log[-2].startswith('INSERT INTO topic_partition')
+    assert conn.log[-1] == 'COMMIT' and conn.log.count('COMMIT') == 1
+
 
 if __name__ == '__main__':
     test_get_config()
     test_read_yaml()
     test_website_checker()
+    test_scheduler()
+    test_diff_websites()
+    test_sharding()
+    test_body_scanner()
+    test_content_cache()
+    test_dns_cache()
+    test_phase_timer()
+    test_metrics()
+    test_record()
+    test_rollup()
+    test_pgcopy()
+    test_transport()
+    test_spool()
+    test_result_queue()
+    test_writer_pipeline()
+    test_database_health_check()
+    test_database_retry()